@@ -0,0 +1,133 @@
+import os
+import sys
+import pickle
+import asyncio
+import argparse
+import itertools
+import email
+import email.parser
+import email.policy
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import custom_functions as F
+
+# Bulk classifier for whole mailboxes (a directory of message files, a Maildir, an mbox
+# file or a tar archive, optionally compressed). File reads run on a thread pool and
+# parsing + scoring on a process pool, connected by a bounded asyncio queue so reading
+# never runs far ahead of scoring.
+# Results are written as "<message id>\t<spam probability>" lines as batches finish:
+#
+#   python batch_scorer.py model.pkl data/spam --n-jobs 4 > scores.tsv
+#
+# --near-duplicates reuses verdicts within campaigns (each worker keeps its own index).
+
+
+# process pool workers get the model once through the initializer
+_worker_model = None
+
+def _init_model_worker(model):
+    global _worker_model
+    _worker_model = model
+
+def _score_batch(raws):
+    parser = email.parser.BytesParser(policy=email.policy.default)
+    X = F.object_array([parser.parsebytes(raw) for raw in raws])
+    return _worker_model.predict_proba(X)[:, 1].tolist()
+
+
+def iter_message_sources(path):
+    # yields (message id, zero-argument reader returning the raw bytes) lazily
+    if os.path.isfile(path):
+        # mbox files and tar archives, possibly compressed, are read sequentially
+        for message_id, raw in F.iter_messages(path):
+            yield message_id, (lambda raw=raw: raw)
+        return
+    # directories and Maildirs in the same order as F.iter_messages
+    for name, filepath in F._message_files(path):
+        yield name, (lambda filepath=filepath: _read_file(filepath))
+
+def _read_file(filepath):
+    with F.open_compressed(filepath) as fp:
+        return fp.read()
+
+
+async def _produce(sources, queue, io_executor, batch_size, n_consumers):
+    loop = asyncio.get_running_loop()
+    batch_ids, batch_reads = [], []
+    sources = iter(sources)
+    while True:
+        # advancing sources reads and decompresses mbox files and archives, so it runs
+        # on the io executor too, a batch of sources at a time
+        chunk = await loop.run_in_executor(io_executor, list, itertools.islice(sources, batch_size))
+        if not chunk:
+            break
+        for message_id, read in chunk:
+            batch_ids.append(message_id)
+            batch_reads.append(loop.run_in_executor(io_executor, read))
+            if len(batch_ids) == batch_size:
+                await queue.put((batch_ids, await asyncio.gather(*batch_reads)))
+                batch_ids, batch_reads = [], []
+    if batch_ids:
+        await queue.put((batch_ids, await asyncio.gather(*batch_reads)))
+    for _ in range(n_consumers):
+        await queue.put(None)
+
+async def _consume(queue, cpu_executor, output, counts):
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        try:
+            if item is None:
+                return
+            message_ids, raws = item
+            probabilities = await loop.run_in_executor(cpu_executor, _score_batch, raws)
+            output.write(''.join('{}\t{:.6f}\n'.format(message_id, probability)
+                                 for message_id, probability in zip(message_ids, probabilities)))
+            counts['scored'] += len(message_ids)
+        finally:
+            queue.task_done()
+
+async def score_mailbox(model, path, output=sys.stdout, n_jobs=1, batch_size=64, max_queue=None, io_threads=4):
+    n_jobs = F.effective_n_jobs(n_jobs)
+    max_queue = max_queue or 2 * n_jobs
+    queue = asyncio.Queue(maxsize=max_queue)
+    counts = {'scored': 0}
+    sources = iter_message_sources(path)
+    # mbox files and archives are read sequentially, on a single io thread
+    io_executor = ThreadPoolExecutor(1 if os.path.isfile(path) else io_threads)
+    if n_jobs == 1:
+        _init_model_worker(model)
+        cpu_executor = ThreadPoolExecutor(1)
+    else:
+        cpu_executor = ProcessPoolExecutor(n_jobs, initializer=_init_model_worker, initargs=(model,))
+    with io_executor, cpu_executor:
+        # a failing consumer cancels the producer too, instead of leaving it blocked on a full queue
+        tasks = [asyncio.create_task(_produce(sources, queue, io_executor, batch_size, n_jobs))]
+        tasks += [asyncio.create_task(_consume(queue, cpu_executor, output, counts)) for _ in range(n_jobs)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+    output.flush()
+    return counts['scored']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score every message of a maildir, directory, mbox file or tar archive.')
+    parser.add_argument('model', help='pickled pipeline ending with a classifier that has predict_proba')
+    parser.add_argument('path', help='directory of message files, Maildir, mbox file or tar archive (optionally compressed)')
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-queue', type=int, default=None)
+    parser.add_argument('--near-duplicates', action='store_true', help='reuse verdicts of already scored near duplicates')
+    args = parser.parse_args()
+    with open(args.model, 'rb') as fp:
+        model = pickle.load(fp)
+    if args.near_duplicates:
+        if not isinstance(model, F.PipelineBundle):
+            parser.error('--near-duplicates needs a model saved with PipelineBundle.save')
+        model = F.NearDuplicateScorer(model)
+    scored = asyncio.run(score_mailbox(model, args.path, sys.stdout, args.n_jobs, args.batch_size, args.max_queue))
+    print('Scored {} messages.'.format(scored), file=sys.stderr)
@@ -0,0 +1,1179 @@
+import os
+import re
+import sys
+import io
+import json
+import queue
+import time
+import platform
+import argparse
+import subprocess
+import random
+import base64
+import gzip
+import tarfile
+import itertools
+import tempfile
+import shutil
+import multiprocessing
+import tracemalloc
+import email
+import email.policy
+import nltk
+import urlextract
+import numpy as np
+import scipy.sparse
+
+from collections import Counter
+from nltk.corpus import stopwords
+from nltk.tokenize import word_tokenize
+
+import custom_functions as F
+
+# Benchmarks for the spam pipeline. Run from the repo root:
+#
+#   python benchmarks.py [--limit N]              old vs new comparisons, printed
+#   python benchmarks.py suite [--limit N]        every stage, written to benchmark_results/
+#   python benchmarks.py compare OLD.json NEW.json
+#
+# Uses the SpamAssassin easy_ham + spam corpora in data/ (see F.get_data_if_needed)
+# and falls back to a seeded synthetic corpus, so no network access is needed.
+
+DATA_DIR = 'data'
+
+_HAM_WORDS = ('meeting tomorrow project update attached report thanks regards please review '
+              'the to a and of in for is on that this with you it be are from your have').split()
+_SPAM_WORDS = ('free money offer click here now unsubscribe remove list viagra mortgage rate '
+               'the to a and of in for is on that this with you it be are from your have').split()
+
+
+def synthetic_email(rng, spam=False, html=False):
+    # ham and spam draw mostly from different word lists so classifiers have signal
+    words = _SPAM_WORDS if spam else _HAM_WORDS
+    other = _HAM_WORDS if spam else _SPAM_WORDS
+    body = ' '.join(rng.choice(words if rng.random() < 0.8 else other) for _ in range(rng.randint(50, 400)))
+    body += ' visit http://www.example{}.com/offer?id={} or call 555-{:04d}'.format(
+        rng.randint(0, 99), rng.randint(0, 9999), rng.randint(0, 9999))
+    ctype = 'html' if html else 'plain'
+    if html:
+        body = '<html><head><title>x</title></head><body><p>{}</p>' \
+               '<a href="http://example.com">link</a></body></html>'.format(body)
+    raw = ('From: sender{}@example.com\nTo: user@example.org\nSubject: {}\n'
+           'MIME-Version: 1.0\nContent-Type: text/{}; charset="us-ascii"\n\n{}\n').format(
+        rng.randint(0, 999), ' '.join(rng.choice(words) for _ in range(5)), ctype, body)
+    return raw.encode('ascii')
+
+
+def synthetic_html_spam(rng, n_links=200, n_words=5000):
+    # long HTML-heavy spam: many distinct links and numbers spread through the markup
+    chunks = []
+    for i in range(n_links):
+        words = ' '.join(rng.choice(_SPAM_WORDS) for _ in range(n_words // n_links))
+        chunks.append('<p>{} ${}.{:02d} <a href="http://promo{}.example.com/c?u={}">http://promo{}.example.com/c?u={}</a>'
+                      '</p>'.format(words, rng.randint(1, 999), rng.randint(0, 99), i, rng.randint(0, 10**6), i, i))
+    body = '<html><head><style>p {{color: red}}</style></head><body>{}</body></html>'.format('\n'.join(chunks))
+    raw = ('From: promo@example.com\nTo: user@example.org\nSubject: LIMITED OFFER\n'
+           'MIME-Version: 1.0\nContent-Type: text/html; charset="us-ascii"\n\n{}\n').format(body)
+    return raw.encode('ascii')
+
+
+def synthetic_attachment_spam(rng, n_attachments=3, attachment_size=200000):
+    # short text/html body plus large base64 attachments, as in image and pdf spam
+    boundary = '==boundary{}=='.format(rng.randint(0, 10**6))
+    text = ' '.join(rng.choice(_SPAM_WORDS) for _ in range(200))
+    parts = ['Content-Type: multipart/alternative; boundary="alt"\n\n'
+             '--alt\nContent-Type: text/plain; charset="us-ascii"\n\n{0}\n'
+             '--alt\nContent-Type: text/html; charset="us-ascii"\n\n<html><body><p>{0}</p>'
+             '<a href="http://promo.example.com">click</a></body></html>\n--alt--\n'.format(text)]
+    for i in range(n_attachments):
+        payload = base64.encodebytes(bytes(rng.getrandbits(8) for _ in range(attachment_size))).decode('ascii')
+        parts.append('Content-Type: image/png; name="offer{0}.png"\nContent-Transfer-Encoding: base64\n'
+                     'Content-Disposition: attachment; filename="offer{0}.png"\n\n{1}'.format(i, payload))
+    raw = ('From: promo@example.com\nTo: user@example.org\nSubject: SEE ATTACHED OFFER\n'
+           'MIME-Version: 1.0\nContent-Type: multipart/mixed; boundary="{0}"\n\n'
+           '{1}\n--{0}--\n').format(boundary, ''.join('--{}\n{}\n'.format(boundary, part) for part in parts))
+    return raw.encode('ascii')
+
+
+def synthetic_corpus(n, seed=42, spam_ratio=0.3):
+    # returns raw messages and their 0/1 labels
+    rng = random.Random(seed)
+    labels = [int(rng.random() < spam_ratio) for _ in range(n)]
+    return [synthetic_email(rng, spam=label, html=rng.random() < 0.3) for label in labels], labels
+
+
+def corpus_source():
+    ham_dir = os.path.join(DATA_DIR, 'easy_ham')
+    spam_dir = os.path.join(DATA_DIR, 'spam')
+    if os.path.isdir(ham_dir) and os.path.isdir(spam_dir):
+        return 'SpamAssassin easy_ham+spam'
+    return 'synthetic'
+
+
+# synthetic corpora written by corpus_dirs, by size; removed when the process exits
+_synthetic_dirs = {}
+
+def corpus_dirs(limit=None):
+    # (directory, filenames) pairs on disk, writing the synthetic corpus to a temp dir if needed
+    ham_dir = os.path.join(DATA_DIR, 'easy_ham')
+    spam_dir = os.path.join(DATA_DIR, 'spam')
+    if corpus_source() != 'synthetic':
+        dirs = [(_dir, [name for name in sorted(os.listdir(_dir)) if name != 'cmds'])
+                for _dir in (ham_dir, spam_dir)]
+    else:
+        n = limit or 3000
+        if n not in _synthetic_dirs:
+            directory = tempfile.TemporaryDirectory()
+            names = []
+            for i, raw in enumerate(synthetic_corpus(n)[0]):
+                names.append('{:05d}'.format(i))
+                with open(os.path.join(directory.name, names[-1]), 'wb') as fp:
+                    fp.write(raw)
+            _synthetic_dirs[n] = directory, names
+        directory, names = _synthetic_dirs[n]
+        dirs = [(directory.name, names)]
+    if limit:
+        dirs = [(_dir, names[:limit]) for _dir, names in dirs]
+    return dirs
+
+
+def load_corpus(limit=None, seed=42):
+    # returns parsed emails and labels, from disk if the corpora exist; a limit takes a
+    # random sample so both classes stay represented
+    ham_dir = os.path.join(DATA_DIR, 'easy_ham')
+    spam_dir = os.path.join(DATA_DIR, 'spam')
+    source = corpus_source()
+    if source != 'synthetic':
+        emails, labels = [], []
+        for label, _dir in enumerate((ham_dir, spam_dir)):
+            names = [name for name in sorted(os.listdir(_dir)) if name != 'cmds']
+            emails += F.extract_emails(_path=_dir, _names=names)
+            labels += [label] * len(names)
+        if limit:
+            index = sorted(random.Random(seed).sample(range(len(emails)), min(limit, len(emails))))
+            emails = [emails[i] for i in index]
+            labels = [labels[i] for i in index]
+    else:
+        parser = email.parser.BytesParser(policy=email.policy.default)
+        raws, labels = synthetic_corpus(limit or 3000, seed)
+        emails = [parser.parsebytes(raw) for raw in raws]
+    return source, F.object_array(emails), np.array(labels)
+
+
+def _legacy_transform(transformer, X):
+    # the pre-TextNormalizer loop, rebuilding every resource for every email
+    X_transformed = []
+    for mail in X:
+        text = F.email_to_text(mail) or ""
+        if transformer.lower_case:
+            text = text.lower()
+        if transformer.replace_urls:
+            url_extractor = urlextract.URLExtract()
+            urls = list(set(url_extractor.find_urls(text)))
+            urls.sort(key=lambda url: len(url), reverse=True)
+            for url in urls:
+                text = text.replace(url, " URL ")
+        if transformer.replace_numbers:
+            text = re.sub(r'\d+(?:\.\d*(?:[eE]\d+))?', 'NUMBER', text)
+        if transformer.remove_punctuation:
+            text = re.sub(r'\W+', ' ', text, flags=re.M)
+        if transformer.remove_stopwords:
+            stop_words = set(stopwords.words("english"))
+            text = [word for word in word_tokenize(text) if not word in stop_words]
+            word_counts = Counter(text)
+        else:
+            word_counts = Counter(text.split())
+        if transformer.stemming:
+            stemmer = nltk.PorterStemmer()
+            stemmed_word_counts = Counter()
+            for word, count in word_counts.items():
+                stemmed_word_counts[stemmer.stem(word)] += count
+            word_counts = stemmed_word_counts
+        X_transformed.append(word_counts)
+    return np.array(X_transformed)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+# what custom_functions imported eagerly before imports were made lazy
+EAGER_IMPORTS = ('nltk', 'nltk.corpus', 'nltk.tokenize', 'urlextract', 'requests', 'tarfile',
+                 'sklearn.feature_extraction', 'sklearn.metrics', 'sklearn.model_selection', 'sklearn.pipeline')
+
+
+def import_time(statement, repeat=3):
+    # cold start of a fresh interpreter running statement, from python -X importtime:
+    # (total ms, [(ms, top-level module)] slowest first), best of repeat
+    best = None
+    for _ in range(repeat):
+        stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                                capture_output=True, text=True, check=True).stderr
+        modules = []
+        for line in stderr.splitlines():
+            match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S.*)$', line)
+            if match:
+                modules.append((int(match.group(1)) / 1000, match.group(2)))
+        total = sum(ms for ms, _ in modules)
+        if best is None or total < best[0]:
+            best = (total, sorted(modules, reverse=True))
+    return best
+
+
+def bench_import_time():
+    print('cold import (python -X importtime)')
+    # sklearn.base stays eager (the transformers subclass it), so it is the floor; a scoring
+    # worker also unpickles a classifier, which pulls in sklearn.linear_model either way
+    eager = 'import {}; '.format(', '.join(EAGER_IMPORTS))
+    for label, statement in (('sklearn.base', 'import sklearn.base'),
+                             ('eager (before)', eager + 'import custom_functions'),
+                             ('custom_functions', 'import custom_functions'),
+                             ('worker, eager', eager + 'import custom_functions, sklearn.linear_model'),
+                             ('worker, lazy', 'import custom_functions, sklearn.linear_model')):
+        total, modules = import_time(statement)
+        print('  {:<17s}: {:7.1f} ms  ({})'.format(label, total, ', '.join(
+            '{} {:.0f}'.format(name, ms) for ms, name in modules[:4])))
+
+
+def bench_normalizer(X, remove_stopwords=False):
+    transformer = F.EmailToWordCounterTransformer_revised(remove_stopwords=remove_stopwords)
+    legacy, legacy_time = timed(_legacy_transform, transformer, X)
+    transformer.fit(X)
+    fitted, fitted_time = timed(transformer.transform, X)
+    assert list(legacy) == list(fitted), 'normalizer output differs from legacy path'
+    print('email_to_wordcount (remove_stopwords={})'.format(remove_stopwords))
+    print('  legacy : {:8.1f} emails/sec'.format(len(X) / legacy_time))
+    print('  fitted : {:8.1f} emails/sec ({:.1f}x)'.format(len(X) / fitted_time, legacy_time / fitted_time))
+
+
+def _legacy_html_to_plaintext(html):
+    text = re.sub('<head.*?>.*?</head>', '', html, flags=re.M | re.S | re.I)
+    text = re.sub(r'<a\s.*?>', ' HYPERLINK ', text, flags=re.M | re.S | re.I)
+    text = re.sub('<.*?>', '', text, flags=re.M | re.S)
+    text = re.sub(r'(\s*\n)+', '\n', text, flags=re.M | re.S)
+    return F.unescape(text)
+
+
+def bench_html(size=4000):
+    # malformed markup that makes the old non-greedy regexes rescan the rest of the text
+    rng = random.Random(42)
+    words = ' '.join(rng.choice(_SPAM_WORDS) for _ in range(size // 6))
+    cases = {
+        'well-formed': synthetic_html_spam(rng).decode('ascii'),
+        'unclosed <head>': '<html>' + '<head x>' * (size // 8) + words,
+        '<head without >': '<head x' * (size // 7) + '</head>' + words,
+        'unclosed tags': '<p' * (size // 2) + words,
+        'unclosed anchors': '<a href=x' * (size // 9) + words,
+        'whitespace runs': ('word' + ' ' * 1000) * (size // 1000),
+    }
+    print('html_to_plaintext (malformed inputs of {} KB)'.format(size // 1000))
+    for name, html in cases.items():
+        legacy, legacy_time = timed(_legacy_html_to_plaintext, html)
+        result, seconds = timed(F.html_to_plaintext, html)
+        assert legacy == result, 'html_to_plaintext differs from legacy regexes on {}'.format(name)
+        print('  {:<17s}: legacy {:9.2f} ms, linear {:7.2f} ms'.format(name, legacy_time * 1000, seconds * 1000))
+
+
+def _legacy_tokenize(normalizer, url_extractor, text):
+    # the sequential lower -> per-url replace -> number -> punctuation -> split chain,
+    # with a stock URLExtract
+    if normalizer.lower_case:
+        text = text.lower()
+    if normalizer.replace_urls:
+        urls = list(set(url_extractor.find_urls(text)))
+        urls.sort(key=lambda url: len(url), reverse=True)
+        for url in urls:
+            text = text.replace(url, " URL ")
+    if normalizer.replace_numbers:
+        text = re.sub(r'\d+(?:\.\d*(?:[eE]\d+))?', 'NUMBER', text)
+    if normalizer.remove_punctuation:
+        text = re.sub(r'\W+', ' ', text, flags=re.M)
+    return text.split()
+
+
+# a url that also appears right after digits elsewhere: a number must not eat its start
+_URL_NUMBER_EDGE_CASES = ('!www.y.net129x.comx.com9x.com9<>9x.com', 'see x.com and 12x.com or 3.5x.com/a')
+
+
+def bench_tokenizer(n_emails=20, seed=42):
+    rng = random.Random(seed)
+    parser = email.parser.BytesParser(policy=email.policy.default)
+    texts = [F.email_to_text(parser.parsebytes(synthetic_html_spam(rng))) for _ in range(n_emails)]
+    print('tokenizer on long HTML spam ({} emails, {:.0f} KB text each)'.format(
+        n_emails, sum(map(len, texts)) / n_emails / 2**10))
+    url_extractor = urlextract.URLExtract()
+    for flags in itertools.product([True, False], repeat=4):
+        lower_case, replace_urls, replace_numbers, remove_punctuation = flags
+        normalizer = F.TextNormalizer(remove_stopwords=False, lower_case=lower_case, replace_urls=replace_urls,
+                                      replace_numbers=replace_numbers, remove_punctuation=remove_punctuation,
+                                      stemming=False)
+        legacy, legacy_time = timed(lambda: [_legacy_tokenize(normalizer, url_extractor, text) for text in texts])
+        tokens, seconds = timed(lambda: [normalizer.tokenize(text) for text in texts])
+        assert legacy == tokens, 'tokens differ from legacy chain for {}'.format(flags)
+        for text in _URL_NUMBER_EDGE_CASES:
+            assert _legacy_tokenize(normalizer, url_extractor, text) == normalizer.tokenize(text), \
+                'tokens differ from legacy chain on {!r} for {}'.format(text, flags)
+        if flags == (True, True, True, True):
+            print('  legacy chain : {:8.1f} emails/sec'.format(n_emails / legacy_time))
+            print('  tokenize     : {:8.1f} emails/sec ({:.1f}x)'.format(n_emails / seconds, legacy_time / seconds))
+    print('  identical tokens for all lower_case/replace_urls/replace_numbers/remove_punctuation flags')
+
+
+def bench_stem_cache(X):
+    # cold run fills the persisted cache, warm run loads it in a fresh transformer
+    print('stem cache')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'stem_cache.json')
+        for run in 'cold', 'warm':
+            transformer = F.EmailToWordCounterTransformer_revised(remove_stopwords=False, stem_cache_path=path)
+            transformer.fit(X)
+            _, seconds = timed(transformer.transform, X)
+            transformer.save_stem_cache()
+            stats = transformer.normalizer_.stem_cache.stats()
+            print('  {} : {:8.1f} emails/sec, {} hits / {} misses ({:.1%})'.format(
+                run, len(X) / seconds, stats['hits'], stats['misses'], stats['hit_rate']))
+
+
+def bench_parallel(X, limit=None):
+    cores = multiprocessing.cpu_count()
+    jobs = sorted(set([1, 2, 4, 8, 16, cores]) & set(range(1, cores + 1)))
+    serial = F.EmailToWordCounterTransformer_revised(remove_stopwords=False).fit_transform(X)
+    print('parallel email_to_wordcount ({} cores)'.format(cores))
+    for n_jobs in jobs:
+        transformer = F.EmailToWordCounterTransformer_revised(remove_stopwords=False, n_jobs=n_jobs)
+        result, seconds = timed(transformer.fit_transform, X)
+        assert list(result) == list(serial), 'parallel output differs from serial path'
+        print('  n_jobs={:<3d}: {:8.1f} emails/sec'.format(n_jobs, len(X) / seconds))
+    print('parallel parse + email_to_wordcount from files')
+    dirs = corpus_dirs(limit)
+    transformer = F.EmailToWordCounterTransformer_revised(remove_stopwords=False)
+    for n_jobs in jobs:
+        start = time.perf_counter()
+        n_emails = 0
+        for _dir, names in dirs:
+            n_emails += len(F.extract_word_counts(_dir, names, transformer, n_jobs=n_jobs))
+        print('  n_jobs={:<3d}: {:8.1f} emails/sec'.format(n_jobs, n_emails / (time.perf_counter() - start)))
+
+
+def bench_word_count_cache(limit=None):
+    # cold run fills the per-document cache, warm run only hashes the raw files
+    dirs = corpus_dirs(limit)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = F.WordCountCache(os.path.join(directory, 'word_counts.sqlite'))
+        transformer = F.EmailToWordCounterTransformer_revised(remove_stopwords=False)
+        print('per-document word count cache')
+        for run in 'cold', 'warm':
+            start = time.perf_counter()
+            n_emails = sum(len(F.extract_word_counts(_dir, names, transformer, cache=cache)) for _dir, names in dirs)
+            print('  {} : {:9.1f} emails/sec'.format(run, n_emails / (time.perf_counter() - start)))
+        stats = cache.stats()
+        print('  {} entries, {:.1f} MB, hit rate {:.1%}'.format(stats['entries'], stats['bytes'] / 2**20, stats['hit_rate']))
+        cache.close()
+
+
+def peak_memory(func, *args, **kwargs):
+    tracemalloc.start()
+    result = func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, peak
+
+
+def bench_streaming(limit=None, batch_size=200):
+    from sklearn.pipeline import Pipeline
+    dirs = corpus_dirs(limit)
+    pipeline = Pipeline([
+        ("email_to_wordcount", F.EmailToWordCounterTransformer_revised(remove_stopwords=False)),
+        ("wordcount_to_vector", F.WordCounterToVectorTransformer()),
+    ])
+    pipeline.fit(F.object_array(F.extract_emails(*dirs[0])[:batch_size]))
+
+    def eager():
+        emails = []
+        for _dir, names in dirs:
+            emails += F.extract_emails(_dir, names)
+        return pipeline.transform(F.object_array(emails))
+
+    def streaming():
+        return scipy.sparse.vstack([F.transform_stream(pipeline, F.iter_email_batches(_dir, names, batch_size))
+                                    for _dir, names in dirs], format='csr')
+
+    print('eager vs streaming load + transform (batch_size={})'.format(batch_size))
+    eager_X, eager_peak = peak_memory(eager)
+    streaming_X, streaming_peak = peak_memory(streaming)
+    assert (eager_X != streaming_X).nnz == 0, 'streaming output differs from eager path'
+    print('  eager     : peak {:8.1f} MB'.format(eager_peak / 2**20))
+    print('  streaming : peak {:8.1f} MB'.format(streaming_peak / 2**20))
+
+
+def email_fixtures():
+    # CPython's test_email messages (RFC 2231 parameters, reused boundaries, missing
+    # header/body separators...), when the test package is installed
+    try:
+        import test.test_email
+    except ImportError:
+        return []
+    _dir = os.path.join(os.path.dirname(test.test_email.__file__), 'data')
+    raws = []
+    for name in sorted(os.listdir(_dir)):
+        if name.startswith('msg_'):
+            with open(os.path.join(_dir, name), 'rb') as fp:
+                raws.append((name, fp.read()))
+    return raws
+
+
+def check_lazy_parsing():
+    # lazy parsing must extract the same text from malformed mail, not just from the
+    # synthetic spam it is timed on
+    parser = email.parser.BytesParser(policy=email.policy.default)
+    fixtures = email_fixtures()
+    for name, raw in fixtures:
+        full = F.email_to_text(parser.parsebytes(raw))
+        lazy = F.email_to_text(F.parse_email_bytes(raw, lazy=True))
+        assert full == lazy, 'lazy parsing changes the extracted text of {}'.format(name)
+    return len(fixtures)
+
+
+def bench_lazy_parsing(n_emails=50, seed=42):
+    # attachment-heavy spam: full parse vs pruning everything but the text parts
+    n_fixtures = check_lazy_parsing()
+    rng = random.Random(seed)
+    raws = [synthetic_attachment_spam(rng) for _ in range(n_emails)]
+    parser = email.parser.BytesParser(policy=email.policy.default)
+
+    def full():
+        return [F.email_to_text(parser.parsebytes(raw)) for raw in raws]
+
+    def lazy():
+        return [F.email_to_text(F.parse_email_bytes(raw, lazy=True)) for raw in raws]
+
+    full_texts, full_time = timed(full)
+    lazy_texts, lazy_time = timed(lazy)
+    assert full_texts == lazy_texts, 'lazy parsing changes the extracted text'
+    _, full_peak = peak_memory(full)
+    _, lazy_peak = peak_memory(lazy)
+    print('parse + email_to_text, attachment-heavy spam ({:.0f} KB/email; same text as a full parse '
+          'for {} test_email fixtures)'.format(sum(map(len, raws)) / len(raws) / 1024, n_fixtures))
+    print('  full : {:8.1f} emails/sec, peak {:6.1f} MB'.format(n_emails / full_time, full_peak / 2**20))
+    print('  lazy : {:8.1f} emails/sec, peak {:6.1f} MB ({:.1f}x)'.format(
+        n_emails / lazy_time, lazy_peak / 2**20, full_time / lazy_time))
+
+
+def bench_sources(limit=None):
+    # the same messages read from extracted files and straight from mail stores
+    import mailbox
+    _dir, names = corpus_dirs(limit)[0]
+    with tempfile.TemporaryDirectory() as workdir:
+        sources = [('extracted files', _dir)]
+        for mode, suffix in (('w', '.tar'), ('w:bz2', '.tar.bz2'), ('w:gz', '.tar.gz')):
+            path = os.path.join(workdir, 'corpus' + suffix)
+            with tarfile.open(path, mode) as tar:
+                for name in names:
+                    tar.add(os.path.join(_dir, name), arcname=os.path.join('corpus', name))
+            sources.append((suffix.lstrip('.'), path))
+        mbox_path = os.path.join(workdir, 'corpus.mbox')
+        mbox = mailbox.mbox(mbox_path)
+        for name in names:
+            with open(os.path.join(_dir, name), 'rb') as fp:
+                mbox.add(fp.read())
+        mbox.close()
+        with open(mbox_path, 'rb') as fp, gzip.open(mbox_path + '.gz', 'wb') as out:
+            out.write(fp.read())
+        sources += [('mbox', mbox_path), ('mbox.gz', mbox_path + '.gz')]
+
+        print('parse {} emails from each source'.format(len(names)))
+        for label, path in sources:
+            if os.path.isdir(path):
+                n_emails, seconds = timed(lambda: len(F.extract_emails(_dir, names)))
+                size = sum(os.stat(os.path.join(_dir, name)).st_blocks * 512 for name in names)
+            else:
+                n_emails, seconds = timed(lambda: sum(1 for _ in F.iter_source_emails(path)))
+                size = os.stat(path).st_blocks * 512
+            print('  {:<15s}: {:8.1f} emails/sec, {:3d} files, {:6.1f} MB on disk'.format(
+                label, n_emails / seconds, len(names) if os.path.isdir(path) else 1, size / 2**20))
+
+
+def _legacy_structures_counter(emails):
+
+    def get_structure(email):
+        payload = email.get_payload()
+        if isinstance(payload, list):
+            return "multipart({})".format(" | ".join([get_structure(sub_email) for sub_email in payload]))
+        return email.get_content_type()
+    return Counter(get_structure(email) for email in emails)
+
+
+def bench_corpus_stats(limit=None, n_jobs=4):
+    # parse everything, then count structures vs one streaming pass over the raw files
+    _dir, names = corpus_dirs(limit)[0]
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            shutil.copy(os.path.join(_dir, name), workdir)
+        rng = random.Random(42)
+        for i in range(max(1, len(names) // 20)):
+            with open(os.path.join(workdir, 'attachment{:04d}'.format(i)), 'wb') as fp:
+                fp.write(synthetic_attachment_spam(rng, attachment_size=20000))
+        names = sorted(os.listdir(workdir))
+
+        def legacy():
+            return _legacy_structures_counter(F.extract_emails(_path=workdir, _names=names))
+
+        legacy_structures, legacy_time = timed(legacy)
+        stats, stream_time = timed(F.corpus_stats, workdir)
+        parallel, parallel_time = timed(F.corpus_stats, workdir, n_jobs=n_jobs)
+        assert stats.structures == legacy_structures == parallel.structures, 'structures differ from structures_counter'
+        assert stats.to_dict() == parallel.to_dict(), 'merged partial aggregates differ'
+        _, legacy_peak = peak_memory(legacy)
+        _, stream_peak = peak_memory(F.corpus_stats, workdir)
+        print('corpus analytics ({} emails, {} structures, {} charsets)'.format(
+            stats.emails, len(stats.structures), len(stats.charsets)))
+        print('  parse all + structures_counter : {:8.1f} emails/sec, peak {:6.1f} MB'.format(
+            len(names) / legacy_time, legacy_peak / 2**20))
+        print('  corpus_stats, streaming        : {:8.1f} emails/sec ({:.1f}x), peak {:6.1f} MB'.format(
+            len(names) / stream_time, legacy_time / stream_time, stream_peak / 2**20))
+        print('  corpus_stats, n_jobs={}         : {:8.1f} emails/sec ({:.1f}x)'.format(
+            n_jobs, len(names) / parallel_time, legacy_time / parallel_time))
+
+def _legacy_word_counts_to_csr(X, vocabulary_, n_features):
+    # the pre-word_counts_to_csr transform: python lists through COO
+    rows, cols, data = [], [], []
+    for row, word_count in enumerate(X):
+        for word, count in word_count.items():
+            rows.append(row)
+            cols.append(vocabulary_.get(word, 0))
+            data.append(count)
+    return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(len(X), n_features))
+
+
+def bench_csr(X, repeat=20):
+    counts = F.EmailToWordCounterTransformer_revised(remove_stopwords=False).fit_transform(X)
+    counts = np.concatenate([counts] * repeat)
+    vectorizer = F.WordCounterToVectorTransformer().fit(counts)
+    legacy, legacy_time = timed(_legacy_word_counts_to_csr, counts, vectorizer.vocabulary_, 1001)
+    print('word counts to csr ({} docs)'.format(len(counts)))
+    print('  {:<14s}: {:9.0f} docs/sec'.format('legacy COO', len(counts) / legacy_time))
+    for dtype in np.int64, np.int32, np.float32:
+        vectorizer.set_params(dtype=dtype)
+        result, seconds = timed(vectorizer.transform, counts)
+        assert (result != legacy).nnz == 0, 'csr output differs from legacy path'
+        print('  {:<14s}: {:9.0f} docs/sec, {:6.1f} MB'.format(
+            'direct ' + np.dtype(dtype).name, len(counts) / seconds,
+            (result.data.nbytes + result.indices.nbytes + result.indptr.nbytes) / 2**20))
+
+
+def retained_memory(func, *args, **kwargs):
+    # bytes still allocated by func's result once it returns
+    tracemalloc.start()
+    result = func(*args, **kwargs)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, retained
+
+
+def bench_token_ids(X, repeat=5):
+    # object array of Counters vs TokenCounts (interned ids + counts + offsets)
+    transformer = F.EmailToWordCounterTransformer_revised(remove_stopwords=False).fit(X)
+    transformer.transform(X[:200])  # warm the stem cache outside the measurements
+    counters, counters_bytes = retained_memory(transformer.transform, X)
+    transformer.set_params(output='token_ids')
+    token_counts, token_counts_bytes = retained_memory(transformer.transform, X)
+    print('word counts intermediate ({} emails, {} tokens)'.format(len(X), len(token_counts.index)))
+    print('  Counters    : {:8.1f} MB retained'.format(counters_bytes / 2**20))
+    print('  TokenCounts : {:8.1f} MB retained, {:.1f} MB of arrays'.format(
+        token_counts_bytes / 2**20, token_counts.nbytes / 2**20))
+    for name, vectorizer in (('fit + transform', F.WordCounterToVectorTransformer()),
+                             ('hashed', F.WordCounterToHashedVectorTransformer(n_features=2**18))):
+        counters_time = min(timed(vectorizer.fit_transform, counters)[1] for _ in range(repeat))
+        token_counts_time = min(timed(vectorizer.fit_transform, token_counts)[1] for _ in range(repeat))
+        assert (vectorizer.fit_transform(counters) != vectorizer.fit_transform(token_counts)).nnz == 0
+        print('  {:<16s}: Counters {:7.1f} ms, TokenCounts {:7.1f} ms ({:.1f}x)'.format(
+            name, counters_time * 1000, token_counts_time * 1000, counters_time / token_counts_time))
+
+
+def synthetic_token_counts(n_docs, n_terms, tokens_per_doc=60, seed=42):
+    # Zipf-distributed term ids, deduplicated within each document
+    rng = np.random.default_rng(seed)
+    ids = np.minimum(rng.zipf(1.1, n_docs * tokens_per_doc), n_terms) - 1
+    rows = np.repeat(np.arange(n_docs), tokens_per_doc)
+    keys, counts = np.unique(rows.astype(np.int64) * n_terms + ids, return_counts=True)
+    offsets = np.searchsorted(keys // n_terms, np.arange(n_docs + 1))
+    index = F.TokenIndex()
+    index.intern('w{}'.format(i) for i in range(n_terms))
+    return F.TokenCounts((keys % n_terms).astype(np.int32), counts.astype(np.int32), offsets, index)
+
+
+def bench_vocabulary_fit(n_docs=30000, n_terms=500000, vocabulary_size=50000):
+    # Counter + most_common() fit vs the bincount/argpartition engine
+    token_counts = synthetic_token_counts(n_docs, n_terms)
+    y = (np.random.default_rng(0).random(n_docs) < 0.3).astype(int)
+    counters = token_counts.to_counters()
+
+    def legacy():
+        total_count = Counter()
+        for word_count in counters:
+            for word, count in word_count.items():
+                total_count[word] += min(count, 10)
+        return total_count.most_common()[:vocabulary_size]
+
+    most_common, legacy_time = timed(legacy)
+    print('vocabulary fit ({} emails, {} distinct terms, vocabulary_size={})'.format(
+        n_docs, len(np.unique(token_counts.ids)), vocabulary_size))
+    print('  Counter.most_common    : {:8.1f} ms'.format(legacy_time * 1000))
+    for ranking in F.RANKINGS:
+        vectorizer = F.WordCounterToVectorTransformer(vocabulary_size=vocabulary_size, ranking=ranking)
+        _, seconds = timed(vectorizer.fit, token_counts, y)
+        if ranking == 'frequency':
+            assert vectorizer.most_common_ == most_common
+        print('  {:<23s}: {:8.1f} ms ({:.1f}x)'.format(ranking, seconds * 1000, legacy_time / seconds))
+
+
+def bench_artifact(X, repeat=50):
+    # load time of the processed training matrix: compressed npz vs memory-mapped artifact
+    counts = F.EmailToWordCounterTransformer_revised(remove_stopwords=False).fit_transform(X)
+    counts = np.concatenate([counts] * repeat)
+    vectorizer = F.WordCounterToVectorTransformer().fit(counts)
+    matrix = vectorizer.transform(counts)
+    with tempfile.TemporaryDirectory() as directory:
+        npz_path = os.path.join(directory, 'X_train.npz')
+        artifact_path = os.path.join(directory, 'X_train.spam')
+        scipy.sparse.save_npz(npz_path, matrix)
+        F.save_artifact(artifact_path, matrix, vectorizer.vocabulary_, params=vectorizer.get_params())
+        print('processed matrix load ({} docs, {} nnz)'.format(matrix.shape[0], matrix.nnz))
+        loaded, seconds = timed(scipy.sparse.load_npz, npz_path)
+        print('  {:<17s}: {:8.2f} ms'.format('load_npz', seconds * 1000))
+        for name, kwargs in (('artifact mmap', {}), ('artifact verified', {'verify': True})):
+            (vocabulary_, loaded), seconds = timed(F.load_artifact, artifact_path, **kwargs)
+            assert (loaded != matrix).nnz == 0 and vocabulary_ == vectorizer.vocabulary_
+            print('  {:<17s}: {:8.2f} ms'.format(name, seconds * 1000))
+
+
+def bench_vectorizers(X, y):
+    from sklearn.linear_model import LogisticRegression, SGDClassifier
+    from sklearn.model_selection import train_test_split
+    from sklearn.metrics import accuracy_score, precision_score, recall_score
+    counts = F.EmailToWordCounterTransformer_revised(remove_stopwords=False).fit_transform(X)
+    C_train, C_test, y_train, y_test = train_test_split(counts, y, test_size=0.2, random_state=42)
+    print('vectorizers (LogisticRegression on a 80/20 split)')
+
+    def report(name, vectorizer):
+        vectorizer, fit_time = timed(vectorizer.fit, C_train)
+        X_train, transform_time = timed(vectorizer.transform, C_train)
+        X_test = vectorizer.transform(C_test)
+        clf = LogisticRegression(solver='liblinear', random_state=42).fit(X_train, y_train)
+        y_pred = clf.predict(X_test)
+        print('  {:<22s}: fit {:6.3f}s, {:9.0f} docs/sec, accuracy {:.3f}, precision {:.3f}, recall {:.3f}'.format(
+            name, fit_time, len(C_train) / transform_time, accuracy_score(y_test, y_pred),
+            precision_score(y_test, y_pred, zero_division=0), recall_score(y_test, y_pred, zero_division=0)))
+
+    report('top-1000 vocabulary', F.WordCounterToVectorTransformer())
+    for bits in 10, 14, 18:
+        report('hashed 2**{}'.format(bits), F.WordCounterToHashedVectorTransformer(n_features=2**bits))
+
+    # out-of-core: hashed batches straight into partial_fit, no fit pass over the corpus
+    vectorizer = F.WordCounterToHashedVectorTransformer(n_features=2**18)
+    clf = SGDClassifier(loss='log_loss', random_state=42)
+    for start in range(0, len(C_train), 200):
+        clf.partial_fit(vectorizer.transform(C_train[start:start + 200]), y_train[start:start + 200], classes=[0, 1])
+    y_pred = clf.predict(vectorizer.transform(C_test))
+    print('  {:<22s}: accuracy {:.3f}, precision {:.3f}, recall {:.3f}'.format(
+        'hashed 2**18 + SGD', accuracy_score(y_test, y_pred),
+        precision_score(y_test, y_pred, zero_division=0), recall_score(y_test, y_pred, zero_division=0)))
+
+
+def bench_incremental(X, y, batch_size=200):
+    # refresh cost per new batch: full refit on all history vs partial_fit on the batch
+    from sklearn.pipeline import Pipeline
+    from sklearn.linear_model import LogisticRegression, SGDClassifier
+    counts = F.EmailToWordCounterTransformer_revised(remove_stopwords=False).fit_transform(X)
+    incremental = Pipeline([("wordcount_to_vector", F.WordCounterToVectorTransformer())])
+    clf = SGDClassifier(loss='log_loss', random_state=42)
+    print('model refresh per batch of {} new emails'.format(batch_size))
+    for end in range(batch_size, len(counts) + 1, batch_size):
+        history = slice(0, end)
+        batch = slice(end - batch_size, end)
+        start = time.perf_counter()
+        vectorizer = F.WordCounterToVectorTransformer().fit(counts[history])
+        LogisticRegression(solver='liblinear').fit(vectorizer.transform(counts[history]), y[history])
+        refit_time = time.perf_counter() - start
+        _, partial_time = timed(F.partial_fit_pipeline, incremental, clf, counts[batch], y[batch])
+        print('  history {:6d}: full refit {:7.1f} ms, partial_fit {:6.1f} ms'.format(
+            end, refit_time * 1000, partial_time * 1000))
+
+
+def bench_scoring_service(X, y, n_requests=300, concurrency=16, port=8097):
+    # end-to-end latency through the HTTP scoring service with a local client
+    import threading
+    import scoring_service as S
+    from concurrent.futures import ThreadPoolExecutor
+    from sklearn.pipeline import Pipeline
+    from sklearn.linear_model import LogisticRegression
+    model = Pipeline([
+        ("email_to_wordcount", F.EmailToWordCounterTransformer_revised(remove_stopwords=False)),
+        ("wordcount_to_vector", F.WordCounterToVectorTransformer()),
+        ("classifier", LogisticRegression(solver='liblinear', random_state=42)),
+    ]).fit(X, y)
+    raws = [mail.as_bytes() for mail in X[:n_requests]]
+    server = S.serve(model, port=port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(port)
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            _, seconds = timed(lambda: list(executor.map(lambda raw: S.score(raw, url), raws)))
+        stats = S.stats(url)
+    finally:
+        server.shutdown()
+        server.server_close()
+    print('scoring service ({} requests, {} concurrent clients)'.format(len(raws), concurrency))
+    print('  {:8.1f} emails/sec, p50 {} ms, p99 {} ms, mean batch {}'.format(
+        len(raws) / seconds, stats['p50_ms'], stats['p99_ms'], stats['mean_batch_size']))
+
+
+def bench_search(X, y, cv=3):
+    # cross_val_score per candidate vs search_pipeline's shared tokenization
+    from sklearn.base import clone
+    from sklearn.pipeline import Pipeline
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import ParameterGrid, cross_val_score
+    pipeline = Pipeline([
+        ("email_to_wordcount", F.EmailToWordCounterTransformer_revised(remove_stopwords=False)),
+        ("wordcount_to_vector", F.WordCounterToVectorTransformer()),
+        ("classifier", LogisticRegression(solver='liblinear')),
+    ])
+    grid = {'email_to_wordcount__stemming': [True, False], 'wordcount_to_vector__vocabulary_size': [100, 1000, 5000],
+            'classifier__C': [0.1, 1.0]}
+    X, y = X[:500], y[:500]
+    naive, naive_time = timed(lambda: [cross_val_score(clone(pipeline).set_params(**params), X, y, cv=cv).tolist()
+                                       for params in ParameterGrid(grid)])
+    search, search_time = timed(F.search_pipeline, pipeline, grid, X, y, cv=cv, refit=False)
+    by_params = {json.dumps(result['params'], sort_keys=True): result['fold_scores'] for result in search['results']}
+    assert all(np.allclose(scores, by_params[json.dumps(params, sort_keys=True)])
+               for params, scores in zip(ParameterGrid(grid), naive)), 'search scores differ from cross_val_score'
+    print('search over {} candidates x {} folds ({} emails)'.format(len(naive), cv, len(X)))
+    print('  cross_val_score each : {:8.2f} s'.format(naive_time))
+    print('  search_pipeline      : {:8.2f} s ({:.1f}x, {} tokenization passes)'.format(
+        search_time, naive_time / search_time, search['n_tokenization_passes']))
+
+
+def bench_bundle(X, y):
+    # notebook flow (pipeline refit on the test set) vs fitting a bundle once and loading it
+    from sklearn.pipeline import Pipeline
+    from sklearn.linear_model import LogisticRegression
+    split = len(X) * 4 // 5
+    X_train, X_test, y_train = X[:split], X[split:], y[:split]
+
+    def refit():
+        preprocess = Pipeline([
+            ("email_to_wordcount", F.EmailToWordCounterTransformer_revised(remove_stopwords=False)),
+            ("wordcount_to_vector", F.WordCounterToVectorTransformer()),
+        ])
+        classifier = LogisticRegression(solver='liblinear').fit(preprocess.fit_transform(X_train), y_train)
+        return classifier, preprocess
+
+    _, refit_time = timed(refit)
+    bundle = F.PipelineBundle.fit(X_train, y_train, F.EmailToWordCounterTransformer_revised(remove_stopwords=False),
+                                  F.WordCounterToVectorTransformer(), LogisticRegression(solver='liblinear'))
+    with tempfile.TemporaryDirectory() as directory:
+        path = bundle.save(os.path.join(directory, 'model.bundle'))
+        loaded, load_time = timed(F.PipelineBundle.load, path)
+        size = os.path.getsize(path)
+    _, score_time = timed(loaded.predict_proba, X_test)
+    print('model bundle ({} train, {} test emails, {:.0f} KB on disk)'.format(
+        len(X_train), len(X_test), size / 1024))
+    print('  refit pipeline : {:8.1f} ms before scoring'.format(refit_time * 1000))
+    print('  load bundle    : {:8.1f} ms before scoring'.format(load_time * 1000))
+    print('  score test set : {:8.1f} emails/sec (first call builds the URL extractor)'.format(
+        len(X_test) / score_time))
+
+
+def synthetic_campaign_traffic(n, n_campaigns=20, campaign_share=0.6, exact_share=0.5, seed=42):
+    # peak-time traffic: unique ham next to spam campaigns whose copies are either exact
+    # or personalized (recipient, tracking url, a few swapped words); returns raw
+    # messages and 0/1 labels
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+                  for _ in range(20000)]
+    templates = [[rng.choice(vocabulary) for _ in range(rng.randint(80, 300))] for _ in range(n_campaigns)]
+
+    def message(words, subject):
+        return ('From: sender{}@example.com\nTo: user{}@example.org\nSubject: {}\n'
+                'Content-Type: text/plain; charset="us-ascii"\n\n{}\n').format(
+            rng.randint(0, 999), rng.randint(0, 9999), subject, ' '.join(words)).encode('ascii')
+
+    messages, labels = [], []
+    for _ in range(n):
+        if rng.random() >= campaign_share:
+            words = [rng.choice(vocabulary) for _ in range(rng.randint(50, 300))]
+            messages.append(message(words, ' '.join(words[:4])))
+            labels.append(0)
+            continue
+        template = templates[rng.randrange(n_campaigns)]
+        words = list(template)
+        if rng.random() >= exact_share:
+            words[0] = 'dear {}'.format(rng.choice(vocabulary))
+            for _ in range(3):
+                words[rng.randrange(len(words))] = rng.choice(vocabulary)
+            words.append('http://track.example.com/{}'.format(rng.randint(0, 10**6)))
+        messages.append(message(words, ' '.join(template[:4])))
+        labels.append(1)
+    return messages, labels
+
+
+def bench_near_duplicates(n=3000, n_train=600, batch_size=64):
+    # micro-batches as the scoring service sees them, with and without the index
+    from sklearn.linear_model import LogisticRegression
+    parser = email.parser.BytesParser(policy=email.policy.default)
+    raws, y = synthetic_campaign_traffic(n)
+    X = F.object_array([parser.parsebytes(raw) for raw in raws])
+    bundle = F.PipelineBundle.fit(X[:n_train], y[:n_train], F.EmailToWordCounterTransformer_revised(remove_stopwords=False),
+                                  F.WordCounterToVectorTransformer(), LogisticRegression(solver='liblinear'))
+    batches = [X[i:i + batch_size] for i in range(n_train, n, batch_size)]
+    scorer = F.NearDuplicateScorer(bundle)
+    full, full_time = timed(lambda: np.vstack([bundle.predict_proba(batch) for batch in batches]))
+    reused, reused_time = timed(lambda: np.vstack([scorer.predict_proba(batch) for batch in batches]))
+    stats = scorer.stats()
+    print('near-duplicate index ({} emails, {:.0f}% in campaigns, batches of {})'.format(
+        n - n_train, 100 * np.mean(y[n_train:]), batch_size))
+    print('  full pipeline : {:8.1f} emails/sec'.format((n - n_train) / full_time))
+    print('  with index    : {:8.1f} emails/sec ({:.1f}x), hit rate {:.2f} ({} exact, {} near), {} clusters'.format(
+        (n - n_train) / reused_time, full_time / reused_time, stats['hit_rate'], stats['exact_hits'],
+        stats['near_hits'], stats['size']))
+    print('  same label for {:.2f}% of emails, max probability difference {:.4f}'.format(
+        100 * np.mean(full.argmax(axis=1) == reused.argmax(axis=1)), np.abs(full - reused).max()))
+
+# ---------------------------------------------------------------------------------------
+# Suite: each stage runs in a fresh spawned process that first builds its inputs, then
+# resets the peak RSS counter (Linux) and times the stage alone.
+
+FLAGS = ('remove_stopwords', 'lower_case', 'remove_punctuation', 'replace_urls', 'replace_numbers', 'stemming')
+
+
+def _rss_reset():
+    # writing 5 to clear_refs resets VmHWM; elsewhere fall back to the process high-water mark
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _rss_peak_mb(reset):
+    if reset:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _setup_stage(stage, params, limit, seed):
+    # returns (callable to time, number of items it processes)
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import train_test_split
+    if stage == 'extract_emails':
+        dirs = corpus_dirs(limit)
+        return (lambda: [F.extract_emails(_dir, names) for _dir, names in dirs]), sum(len(names) for _, names in dirs)
+    _, X, y = load_corpus(limit, seed)
+    if stage == 'email_to_text':
+        return (lambda: [F.email_to_text(mail) for mail in X]), len(X)
+    if stage == 'email_to_wordcount':
+        transformer = F.EmailToWordCounterTransformer_revised(**params).fit(X)
+        return (lambda: transformer.transform(X)), len(X)
+    counts = F.EmailToWordCounterTransformer_revised(remove_stopwords=False).fit_transform(X)
+    if stage == 'wordcount_to_vector':
+        return (lambda: F.WordCounterToVectorTransformer(**params).fit(counts).transform(counts)), len(counts)
+    if stage == 'wordcount_to_hashed_vector':
+        return (lambda: F.WordCounterToHashedVectorTransformer(**params).fit(counts).transform(counts)), len(counts)
+    matrix = F.WordCounterToVectorTransformer().fit_transform(counts)
+    X_train, X_test, y_train, y_test = train_test_split(matrix, y, test_size=0.2, random_state=seed)
+    if stage == 'classifier_fit':
+        return (lambda: LogisticRegression(solver='liblinear', random_state=seed).fit(X_train, y_train)), X_train.shape[0]
+    if stage == 'classifier_predict':
+        clf = LogisticRegression(solver='liblinear', random_state=seed).fit(X_train, y_train)
+        return (lambda: clf.predict_proba(X_test)), X_test.shape[0]
+    raise ValueError('Unknown stage {}'.format(stage))
+
+
+def _run_stage(stage, params, limit, seed, results):
+    try:
+        func, n_items = _setup_stage(stage, params, limit, seed)
+        reset = _rss_reset()
+        baseline = _rss_peak_mb(reset)
+        _, seconds = timed(func)
+        peak = _rss_peak_mb(reset)
+        results.put({'stage': stage, 'params': params, 'n_items': n_items, 'seconds': seconds,
+                     'items_per_sec': n_items / seconds if seconds else None,
+                     'peak_rss_mb': peak, 'rss_increase_mb': peak - baseline})
+    except LookupError as e:
+        # e.g. NLTK stopwords/punkt data not installed
+        message = [line.strip() for line in str(e).splitlines() if line.strip().strip('*')]
+        results.put({'stage': stage, 'params': params, 'skipped': message[0] if message else repr(e)})
+    except Exception as e:
+        results.put({'stage': stage, 'params': params, 'failed': repr(e)})
+
+
+def _stage_result(process, results, stage, params, poll=1.0):
+    # waits for the stage's result, or for its process to die without one (killed,
+    # out of memory, crashed in C code)
+    while True:
+        try:
+            return results.get(timeout=poll)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        try:
+            return results.get(timeout=poll)
+        except queue.Empty:
+            return {'stage': stage, 'params': params,
+                    'failed': 'process exited with code {} and no result'.format(process.exitcode)}
+
+
+def suite_stages():
+    stages = [('extract_emails', {}), ('email_to_text', {})]
+    for values in itertools.product([False, True], repeat=len(FLAGS)):
+        stages.append(('email_to_wordcount', dict(zip(FLAGS, values))))
+    for vocabulary_size in 1000, 10000:
+        stages.append(('wordcount_to_vector', {'vocabulary_size': vocabulary_size}))
+    for n_features in 2**10, 2**20:
+        stages.append(('wordcount_to_hashed_vector', {'n_features': n_features}))
+    stages += [('classifier_fit', {}), ('classifier_predict', {})]
+    return stages
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(limit=None, seed=42, output_dir='benchmark_results', stage_filter=None):
+    import sklearn
+    context = multiprocessing.get_context('spawn')
+    source = corpus_source()
+    commit = _git_commit()
+    results = []
+    for stage, params in suite_stages():
+        if stage_filter and stage not in stage_filter:
+            continue
+        stage_results = context.Queue()
+        process = context.Process(target=_run_stage, args=(stage, params, limit, seed, stage_results))
+        process.start()
+        result = _stage_result(process, stage_results, stage, params)
+        process.join()
+        results.append(result)
+        label = ' '.join('{}={}'.format(key, value) for key, value in params.items())
+        if 'skipped' in result:
+            print('  {:<26s} {} skipped: {}'.format(stage, label, result['skipped']))
+        elif 'failed' in result:
+            print('  {:<26s} {} failed: {}'.format(stage, label, result['failed']))
+        else:
+            print('  {:<26s} {:10.1f} items/sec  peak {:7.1f} MB (+{:.1f})  {}'.format(
+                stage, result['items_per_sec'], result['peak_rss_mb'], result['rss_increase_mb'], label))
+    report = {'commit': commit, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'numpy': np.__version__, 'scipy': scipy.__version__, 'sklearn': sklearn.__version__,
+              'cpu_count': multiprocessing.cpu_count(), 'corpus': source, 'limit': limit, 'seed': seed,
+              'results': results}
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    path = os.path.join(output_dir, '{}_{}.json'.format(time.strftime('%Y%m%d-%H%M%S'), commit or 'nocommit'))
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=4)
+    print('Results written to ' + path)
+    return path
+
+
+def compare(old_path, new_path):
+    with open(old_path) as fp:
+        old = json.load(fp)
+    with open(new_path) as fp:
+        new = json.load(fp)
+    key = lambda result: (result['stage'], json.dumps(result['params'], sort_keys=True))
+    old_results = {key(result): result for result in old['results']
+                   if 'skipped' not in result and 'failed' not in result}
+    print('{} ({}) -> {} ({})'.format(old['commit'], old['timestamp'], new['commit'], new['timestamp']))
+    for result in new['results']:
+        before = old_results.get(key(result))
+        if before is None or 'skipped' in result or 'failed' in result:
+            continue
+        label = ' '.join('{}={}'.format(k, v) for k, v in result['params'].items())
+        print('  {:<26s} speed {:6.2f}x  peak rss {:+8.1f} MB  {}'.format(
+            result['stage'], result['items_per_sec'] / before['items_per_sec'],
+            result['peak_rss_mb'] - before['peak_rss_mb'], label))
+
+
+# ---------------------------------------------------------------------------------------
+# Checks: behaviour the benchmarks do not exercise, run with `python benchmarks.py check`.
+
+def _archive(name, files):
+    # a .tar.bz2 in memory holding name/<file> for each (file, bytes) pair
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:bz2') as tar:
+        for filename, data in files:
+            info = tarfile.TarInfo(os.path.join(name, filename))
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def corpus_server(archives, port=0):
+    # local stand-in for the corpus site: serves archives {path: bytes} with Range
+    # support and 404 otherwise; archives can be swapped and server.requests lists
+    # (path, Range header) of every GET. server.truncate = n cuts the next response
+    # after n bytes, as a dropped connection would.
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class CorpusHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            server.requests.append((self.path, self.headers.get('Range')))
+            data = server.archives.get(self.path)
+            if data is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            offset = 0
+            match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+            if match:
+                offset = int(match.group(1))
+                if offset >= len(data):
+                    self.send_response(416)
+                    self.send_header('Content-Length', '0')
+                    return self.end_headers()
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(offset, len(data) - 1, len(data)))
+            else:
+                self.send_response(200)
+            body = data[offset:]
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            truncate, server.truncate = server.truncate, None
+            self.wfile.write(body if truncate is None else body[:truncate])
+            if truncate is not None:
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), CorpusHandler)
+    server.daemon_threads = True
+    server.archives = dict(archives)
+    server.requests = []
+    server.truncate = None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check_fetcher():
+    # resume after a dropped connection, manifest skip, a checksum mismatch keeping
+    # the corpus already extracted, and failures collected across corpora
+    import hashlib
+    rng = random.Random(42)
+    spam = _archive('spam', [('{:05d}'.format(i), synthetic_email(rng, spam=True)) for i in range(200)])
+    ham = _archive('easy_ham', [('{:05d}'.format(i), synthetic_email(rng)) for i in range(100)])
+    server = corpus_server({'/20030228_spam.tar.bz2': spam, '/20030228_easy_ham.tar.bz2': ham})
+    base_url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    data_dir = tempfile.mkdtemp()
+    try:
+        # a connection dropped halfway leaves a .part file, the next call resumes it
+        server.truncate = len(spam) // 2
+        try:
+            F.fetch_corpora(['spam'], data_dir=data_dir, base_url=base_url, chunk_size=1024)
+            raise AssertionError('a truncated download went unnoticed')
+        except RuntimeError:
+            pass
+        part_size = os.path.getsize(os.path.join(data_dir, 'spam.tar.bz2.part'))
+        assert 0 < part_size <= len(spam) // 2, 'partial download not kept'
+        manifest = F.fetch_corpora(['spam', 'easy_ham'], data_dir=data_dir, base_url=base_url)
+        assert ('/20030228_spam.tar.bz2', 'bytes={}-'.format(part_size)) in server.requests, 'download not resumed'
+        assert manifest['spam']['sha256'] == hashlib.sha256(spam).hexdigest(), 'resumed archive hashed wrong'
+        assert manifest['spam']['files'] == 200 and manifest['easy_ham']['files'] == 100
+        assert sorted(os.listdir(data_dir)) == ['easy_ham', F.MANIFEST_NAME, 'spam']
+
+        # current corpora are not fetched again
+        n_requests = len(server.requests)
+        F.fetch_corpora(['spam', 'easy_ham'], data_dir=data_dir, base_url=base_url)
+        assert len(server.requests) == n_requests, 'current corpora fetched again'
+
+        # a changed archive that fails its checksum leaves the extracted corpus alone
+        server.archives['/20030228_spam.tar.bz2'] = _archive('spam', [('00000', b'Subject: x\n\nchanged\n')])
+        try:
+            F.fetch_corpora(['spam'], data_dir=data_dir, base_url=base_url, checksums={'spam': '0' * 64})
+            raise AssertionError('checksum mismatch went unnoticed')
+        except RuntimeError as e:
+            assert 'ChecksumError' in str(e)
+        assert len(os.listdir(os.path.join(data_dir, 'spam'))) == 200, 'corpus replaced despite the mismatch'
+        assert not os.path.exists(os.path.join(data_dir, 'spam.tar.bz2.part')), 'mismatched download kept'
+        assert F.read_manifest(data_dir)['spam'] == manifest['spam']
+
+        # a missing corpus fails without stopping the others, all failures raised together
+        server.archives['/20030228_spam.tar.bz2'] = spam
+        shutil.rmtree(os.path.join(data_dir, 'easy_ham'))
+        try:
+            F.fetch_corpora(['easy_ham', 'hard_ham', 'spam_2'], data_dir=data_dir, base_url=base_url)
+            raise AssertionError('404s went unnoticed')
+        except RuntimeError as e:
+            assert 'hard_ham' in str(e) and 'spam_2' in str(e) and 'easy_ham' not in str(e)
+        assert len(os.listdir(os.path.join(data_dir, 'easy_ham'))) == 100, 'other corpora not fetched'
+        assert set(F.read_manifest(data_dir)) == {'spam', 'easy_ham'}
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(data_dir)
+    print('fetcher: resume, manifest skip, checksum mismatch and failure aggregation ok')
+
+
+def run_checks():
+    check_fetcher()
+    print('lazy parsing: same text as a full parse for {} test_email fixtures'.format(check_lazy_parsing()))
+
+
+def run_comparisons(limit=None):
+    bench_import_time()
+    source, X, y = load_corpus(limit)
+    print('{} emails ({})\n'.format(len(X), source))
+    bench_normalizer(X)
+    bench_stem_cache(X)
+    bench_tokenizer()
+    bench_html()
+    bench_parallel(X, limit)
+    bench_streaming(limit)
+    bench_lazy_parsing()
+    bench_sources(limit)
+    bench_corpus_stats(limit)
+    bench_word_count_cache(limit)
+    bench_csr(X)
+    bench_artifact(X)
+    bench_token_ids(X)
+    bench_vocabulary_fit()
+    bench_vectorizers(X, y)
+    bench_incremental(X, y)
+    bench_search(X, y)
+    bench_bundle(X, y)
+    bench_near_duplicates()
+    bench_scoring_service(X, y)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Spam pipeline benchmarks.')
+    parser.add_argument('command', nargs='?', default='compare-legacy', choices=['compare-legacy', 'suite', 'compare', 'check'])
+    parser.add_argument('files', nargs='*', help='two result files for compare')
+    parser.add_argument('--limit', type=int, default=None, help='number of emails (default: whole corpus)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output-dir', default='benchmark_results')
+    parser.add_argument('--stage', action='append', help='only run these suite stages')
+    args = parser.parse_args()
+    if args.command == 'suite':
+        run_suite(args.limit, args.seed, args.output_dir, args.stage)
+    elif args.command == 'compare':
+        compare(*args.files)
+    elif args.command == 'check':
+        run_checks()
+    else:
+        run_comparisons(args.limit)
@@ -1,121 +1,933 @@
 import os
 import re
 import json
-import nltk
+import copy
+import time
+import pickle
+import sqlite3
+import hashlib
+import array
+import binascii
+import functools
+import itertools
+import operator
 import email
-import tarfile
-import requests
-import urlextract 
+import bz2
+import gzip
+import lzma
+import zlib
+import shutil
 import numpy as np
+import email.parser
+import email.utils
 import email.policy
 import scipy.sparse
+import string
 import datetime as dt
+import multiprocessing
     
 from html import unescape
-from collections import Counter
-from nltk.corpus import stopwords 
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from scipy.sparse import csr_matrix
-from nltk.tokenize import word_tokenize
-from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+
+# nltk, urlextract, requests, tarfile and the rest of scikit-learn are imported where
+# they are first needed: nltk alone takes longer to import than everything above, and
+# a scoring worker that loads a bundle with a warm stem cache may never need it
+# (benchmarks.py import-time shows the cold start).
+
+# Opt-in pipeline instrumentation. enable_profiling() installs a PipelineProfiler that
+# the parsing, text extraction, normalization and vectorization functions report to;
+# while it is None each instrumented call only pays for one global lookup. Workers of
+# a process pool have their own profiler, profile with n_jobs=1 or merge() exports.
+
+class PipelineProfiler:
+    # per stage: call count, total seconds, a cumulative latency histogram, and the
+    # bytes and tokens that went through it
+    
+    BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0, float('inf'))
+    
+    def __init__(self):
+        self.stages = {}
+    
+    def record(self, stage, seconds, nbytes=0, ntokens=0):
+        aggregate = self.stages.get(stage)
+        if aggregate is None:
+            aggregate = self.stages[stage] = {'count': 0, 'seconds': 0.0, 'bytes': 0, 'tokens': 0,
+                                              'buckets': [0] * len(self.BUCKETS)}
+        aggregate['count'] += 1
+        aggregate['seconds'] += seconds
+        aggregate['bytes'] += nbytes
+        aggregate['tokens'] += ntokens
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                aggregate['buckets'][i] += 1
+                break
+    
+    def merge(self, other):
+        other = other.stages if isinstance(other, PipelineProfiler) else other
+        for stage, theirs in other.items():
+            ours = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'tokens': 0,
+                                                  'buckets': [0] * len(self.BUCKETS)})
+            for key in ('count', 'seconds', 'bytes', 'tokens'):
+                ours[key] += theirs[key]
+            ours['buckets'] = [a + b for a, b in zip(ours['buckets'], theirs['buckets'])]
+        return self
+    
+    def reset(self):
+        self.stages = {}
+    
+    def to_json(self):
+        return json.dumps({'buckets': [str(bound) for bound in self.BUCKETS], 'stages': self.stages}, indent=4)
+    
+    def to_prometheus(self, prefix='spam_pipeline'):
+        lines = ['# HELP {}_stage_seconds Time spent per pipeline stage call.'.format(prefix),
+                 '# TYPE {}_stage_seconds histogram'.format(prefix)]
+        for stage, aggregate in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, aggregate['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, stage, le, cumulative))
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(prefix, stage, aggregate['seconds']))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, stage, aggregate['count']))
+        for key in 'bytes', 'tokens':
+            lines.append('# HELP {}_stage_{}_total {} processed per pipeline stage.'.format(prefix, key, key.capitalize()))
+            lines.append('# TYPE {}_stage_{}_total counter'.format(prefix, key))
+            for stage, aggregate in sorted(self.stages.items()):
+                lines.append('{}_stage_{}_total{{stage="{}"}} {}'.format(prefix, key, stage, aggregate[key]))
+        return '\n'.join(lines) + '\n'
+
+_profiler = None
+
+def enable_profiling(profiler=None):
+    global _profiler
+    _profiler = profiler or PipelineProfiler()
+    return _profiler
+
+def disable_profiling():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def get_profiler():
+    return _profiler
+
+# Corpus fetcher. Archives are streamed to disk in chunks (a partial download resumes
+# with an HTTP Range request), hashed and extracted in the same pass, and fetched
+# concurrently. data/manifest.json records the url, sha256, size and file count of
+# every extracted corpus, and a corpus is fetched again only when it is missing from
+# the manifest, its directory changed, or a different url or checksum is asked for.
+
+CORPUS_URL = 'http://spamassassin.apache.org/old/publiccorpus/'
+MANIFEST_NAME = 'manifest.json'
+
+class ChecksumError(Exception):
+    pass
+
+class _TeeReader:
+    # file-like object for tarfile's stream mode: replays the bytes of a partial
+    # download already on disk, then reads from the HTTP response while appending
+    # to the partial file; everything read is hashed
+    def __init__(self, part_path, chunks):
+        self.part = open(part_path, 'rb')
+        self.out = None
+        self.part_path = part_path
+        self.chunks = chunks
+        self.complete = False
+        self.sha256 = hashlib.sha256()
+        self.nbytes = 0
+        self.buffer = memoryview(b'')
+    
+    def _next_chunk(self):
+        chunk = self.part.read(2**16) if self.part is not None else b''
+        if not chunk and not self.complete:
+            if self.part is not None:
+                self.part.close()
+                self.part = None
+                self.out = open(self.part_path, 'ab')
+            chunk = next(self.chunks, b'')
+            self.out.write(chunk)
+            self.complete = not chunk
+        self.sha256.update(chunk)
+        self.nbytes += len(chunk)
+        return chunk
+    
+    def read(self, size=-1):
+        # may return fewer than size bytes, tarfile's stream reader loops until it has enough
+        if not self.buffer:
+            self.buffer = memoryview(self._next_chunk())
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return bytes(data)
+    
+    def drain(self):
+        # hash whatever tarfile did not read (end-of-archive padding)
+        while self.read(2**16):
+            pass
+    
+    def close(self):
+        for fp in (self.part, self.out):
+            if fp is not None:
+                fp.close()
+
+def _open_download(url, offset, chunk_size, timeout):
+    # returns (response, offset actually resumed from)
+    import requests
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    response = requests.get(url, headers=headers, stream=True, timeout=timeout)
+    if response.status_code == 416 and offset:
+        # the partial file is already complete (or stale); start over
+        response.close()
+        return _open_download(url, 0, chunk_size, timeout)
+    response.raise_for_status()
+    if offset and response.status_code != 206:
+        offset = 0
+    return response, offset
+
+def _safe_members(tar, destination):
+    # skips links and absolute or parent-relative paths
+    root = os.path.realpath(destination)
+    for member in tar:
+        path = os.path.realpath(os.path.join(root, member.name))
+        if (member.isfile() or member.isdir()) and os.path.commonpath([root, path]) == root:
+            yield member
+
+def _count_files(directory):
+    return sum(len(files) for _, _, files in os.walk(directory))
+
+def read_manifest(data_dir='data'):
+    try:
+        with open(os.path.join(data_dir, MANIFEST_NAME), 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+def _write_manifest(data_dir, manifest):
+    path = os.path.join(data_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=4, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def corpus_is_current(name, url, data_dir='data', checksum=None, manifest=None):
+    entry = (read_manifest(data_dir) if manifest is None else manifest).get(name)
+    directory = os.path.join(data_dir, name)
+    return (entry is not None and entry['url'] == url and os.path.isdir(directory)
+            and (checksum is None or entry['sha256'] == checksum)
+            and _count_files(directory) == entry['files'])
+
+def fetch_corpus(name, url, data_dir='data', checksum=None, chunk_size=2**16, timeout=60):
+    # downloads and extracts one .tar.bz2 archive into data_dir/name and returns its
+    # manifest entry; raises ChecksumError (and discards the download) on a mismatch
+    import tarfile
+    part_path = os.path.join(data_dir, name + '.tar.bz2.part')
+    staging = os.path.join(data_dir, '.' + name + '.extracting')
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    response, offset = _open_download(url, offset, chunk_size, timeout)
+    if offset == 0:
+        open(part_path, 'wb').close()
+    print('Downloading ' + name + ('...' if not offset else ' (resuming at {} bytes)...'.format(offset)))
+    
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+    reader = _TeeReader(part_path, response.iter_content(chunk_size))
+    try:
+        with tarfile.open(fileobj=reader, mode='r|bz2') as tar:
+            for member in _safe_members(tar, staging):
+                tar.extract(member, staging)
+        reader.drain()
+    except tarfile.TarError:
+        # a fully downloaded but unreadable archive would fail again on resume
+        if reader.complete:
+            reader.close()
+            os.remove(part_path)
+        raise
+    finally:
+        reader.close()
+        response.close()
+    
+    sha256 = reader.sha256.hexdigest()
+    if checksum is not None and sha256 != checksum:
+        os.remove(part_path)
+        shutil.rmtree(staging)
+        raise ChecksumError('{}: expected sha256 {}, got {}'.format(url, checksum, sha256))
+    
+    # archives hold a single top-level directory; it becomes data_dir/name
+    entries = os.listdir(staging)
+    source = os.path.join(staging, entries[0]) if len(entries) == 1 else staging
+    directory = os.path.join(data_dir, name)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.replace(source, directory)
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+    os.remove(part_path)
+    print('Extracted ' + name + '.')
+    return {'url': url, 'sha256': sha256, 'bytes': reader.nbytes, 'files': _count_files(directory),
+            'fetched': dt.datetime.now().isoformat(timespec='seconds')}
+
+def fetch_corpora(names, date='20030228', data_dir='data', base_url=CORPUS_URL, checksums=None,
+                  max_workers=4, chunk_size=2**16, timeout=60):
+    # fetches the SpamAssassin corpora `names` (e.g. ['spam', 'easy_ham']) that are not
+    # current in the manifest, concurrently; checksums maps names to expected sha256s.
+    # Failures are collected and raised together once the other downloads finished.
+    checksums = checksums or {}
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    manifest = read_manifest(data_dir)
+    urls = {name: ''.join([base_url, date, '_', name, '.tar.bz2']) for name in names}
+    todo = [name for name in names
+            if not corpus_is_current(name, urls[name], data_dir, checksums.get(name), manifest)]
+    if not todo:
+        return manifest
+    
+    errors = {}
+    with ThreadPoolExecutor(max(1, min(max_workers, len(todo)))) as executor:
+        futures = {name: executor.submit(fetch_corpus, name, urls[name], data_dir, checksums.get(name),
+                                         chunk_size, timeout) for name in todo}
+        for name, future in futures.items():
+            try:
+                manifest[name] = future.result()
+            except Exception as e:
+                errors[name] = e
+    _write_manifest(data_dir, manifest)
+    if errors:
+        raise RuntimeError('Failed fetching ' + ', '.join('{} ({!r})'.format(name, e) for name, e in errors.items()))
+    return manifest
 
 def get_data(spam, ham):
-    if os.path.isdir('data'):
-        pass
+    # kept for the notebooks: arguments are '<date>_<corpus>' archive names
+    by_date = {}
+    for archive in spam, ham:
+        date, name = archive.split('_', 1)
+        by_date.setdefault(date, []).append(name)
+    for date, names in by_date.items():
+        fetch_corpora(names, date)
+
+def get_data_if_needed(spam, ham, date):
+    fetch_corpora([spam, ham], date)
+    print('Data successfully downloaded.')
+        
+def effective_n_jobs(n_jobs):
+    # same convention as sklearn: None means 1, -1 means all cores, -2 all but one...
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+# Lazy MIME parsing: email_to_text only ever reads text/plain and text/html parts, so
+# text_parts_only() rebuilds a message from the raw bytes keeping the headers, the
+# multipart skeleton and the text parts (optionally truncated to max_part_bytes) and
+# drops every other body unparsed and undecoded. The text email_to_text extracts is
+# unchanged (up to the truncation); structures_counter sees the pruned tree. Malformed
+# structures the feed parser resolves in its own way (headers without a blank line
+# after them, a nested multipart reusing an outer boundary, empty parts between
+# delimiters) are not pruned at all: the message is parsed as it is.
+
+_HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+def _split_headers(raw):
+    if raw.startswith(b'\n') or raw.startswith(b'\r\n'):
+        return b'', raw[1:] if raw.startswith(b'\n') else raw[2:]
+    match = _HEADER_END.search(raw)
+    if match is None:
+        return raw, b''
+    return raw[:match.start()], raw[match.end():]
+
+def _truncate_body(body, max_part_bytes):
+    # cut at a line boundary so base64/quoted-printable still decode
+    if max_part_bytes is None or len(body) <= max_part_bytes:
+        return body
+    cut = body.rfind(b'\n', 0, max_part_bytes)
+    return body[:cut + 1] if cut != -1 else body[:max_part_bytes]
+
+class _Unprunable(Exception):
+    pass
+
+def _prune_part(raw, max_part_bytes, default_type='text/plain', outer_boundaries=()):
+    header_bytes, body = _split_headers(raw)
+    headers = email.parser.BytesHeaderParser(policy=email.policy.compat32).parsebytes(header_bytes + b'\n\n')
+    if headers.defects:
+        raise _Unprunable()
+    if headers.get('content-type') is None:
+        ctype = default_type
     else:
-        os.mkdir('data')  
-    _head = 'http://spamassassin.apache.org/old/publiccorpus/'
-    _ext = '.tar.bz2'
-    _spam = ''.join([_head, spam, _ext])
-    _ham = ''.join([_head, ham, _ext])
-    for _url in _spam, _ham:     
-        # extract dir name from _url
-        _dir = _url.split('/')[len(_url.split('/'))-1].split('.')[0]
-        _filepath = os.path.join('data', _dir)      
-        try:
-            r = requests.get(_url)        
-            if r.status_code == 200:
-                print('Downloading ' + _dir + '...')
-            else:
-                print('Request failed with error status code: ' + str(r.status_code) +'\n')
-        except:
-            print('Request error.\n')
-            continue    
-        try:
-            f = open(_filepath, 'wb')
-            f.write(r.content)
-            f.close()
-            print('Saving data...')
-        except:
-            print('Failed writing to folders.\n')
-            continue     
-        try:
-            t = tarfile.open(_filepath, 'r:bz2')
-            t.extractall('data')
-            t.close()
-            os.remove(_filepath)
-            print('Extracting files...\n')
-        except:
-            print('Failed extracting files.\n')
-            print(_filepath)
+        ctype = headers.get_content_type()
+    newline = b'\r\n' if b'\r\n' in header_bytes[:200] else b'\n'
+    head = header_bytes + newline + newline if header_bytes else newline
+    
+    if ctype in ('text/plain', 'text/html'):
+        return head + _truncate_body(body, max_part_bytes)
+    if ctype == 'message/rfc822':
+        return head + _prune_part(body, max_part_bytes, outer_boundaries=outer_boundaries)
+    boundary = headers.get_param('boundary') if headers.get_content_maintype() == 'multipart' else None
+    if not boundary:
+        return head
+    
+    # RFC 2231 parameters (boundary*=...) come back as (charset, language, value)
+    boundary = email.utils.collapse_rfc2231_value(boundary).encode('ascii', 'replace')
+    if boundary in outer_boundaries:
+        raise _Unprunable()
+    outer_boundaries += (boundary,)
+    sub_default = 'message/rfc822' if ctype == 'multipart/digest' else 'text/plain'
+    pieces = [head]
+    start = None
+    for line_start, line_end, closing in _iter_delimiters(body, boundary):
+        if start is not None:
+            # the line break before a delimiter belongs to the delimiter
+            end = line_start - 1
+            if end > start and body[end - 1:end] == b'\r':
+                end -= 1
+            if end <= start:
+                raise _Unprunable()
+            pieces.append(b'--' + boundary + newline)
+            pieces.append(_prune_part(body[start:end], max_part_bytes, sub_default, outer_boundaries) + newline)
+        if closing:
+            start = None
+            break
+        start = line_end
+    if start is not None:
+        # unterminated multipart: keep the last part as the lenient parser does
+        pieces.append(b'--' + boundary + newline)
+        pieces.append(_prune_part(body[start:], max_part_bytes, sub_default, outer_boundaries) + newline)
+    pieces.append(b'--' + boundary + b'--' + newline)
+    return b''.join(pieces)
+
+def _iter_delimiters(body, boundary):
+    # yields (start, end past the line break, closing) for each "--boundary" or
+    # "--boundary--" line; bytes.find skips attachment bodies much faster than a
+    # multiline regex
+    marker = b'--' + boundary
+    position = body.find(marker)
+    while position != -1:
+        after = position + len(marker)
+        line_end = body.find(b'\n', after)
+        line_end = len(body) if line_end == -1 else line_end + 1
+        if position == 0 or body[position - 1:position] == b'\n':
+            rest = body[after:line_end].rstrip()
+            if rest in (b'', b'--'):
+                yield position, line_end, rest == b'--'
+        position = body.find(marker, line_end)
+
+def text_parts_only(raw, max_part_bytes=None):
+    try:
+        return _prune_part(raw, max_part_bytes)
+    except _Unprunable:
+        return raw
+
+def parse_email_bytes(raw, lazy=False, max_part_bytes=None):
+    profiler = _profiler
+    if profiler is not None:
+        start = time.perf_counter()
+    nbytes = len(raw)
+    if lazy:
+        raw = text_parts_only(raw, max_part_bytes)
+    parsed = email.parser.BytesParser(policy=email.policy.default).parsebytes(raw)
+    if profiler is not None:
+        profiler.record('parse', time.perf_counter() - start, nbytes=nbytes)
+    return parsed
+
+def parse_email_file(filepath, lazy=False, max_part_bytes=None):
+    if lazy:
+        with open(filepath, 'rb') as fp:
+            return(parse_email_bytes(fp.read(), lazy, max_part_bytes))
+    profiler = _profiler
+    if profiler is not None:
+        start = time.perf_counter()
+    with open(filepath, 'rb') as fp:
+        parsed = email.parser.BytesParser(policy=email.policy.default).parse(fp)
+        if profiler is not None:
+            profiler.record('parse', time.perf_counter() - start, nbytes=fp.tell())
+    return(parsed)
+
+def extract_emails(_path, _names, n_jobs=1, chunksize=64, lazy=False, max_part_bytes=None):
+    filepaths = [os.path.join(_path, name) for name in _names]
+    parse = functools.partial(parse_email_file, lazy=lazy, max_part_bytes=max_part_bytes)
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs == 1:
+        return([parse(filepath) for filepath in filepaths])
+    # Pool.map keeps the input order
+    with multiprocessing.Pool(n_jobs) as pool:
+        return(pool.map(parse, filepaths, chunksize=chunksize))
+
+def iter_emails(_path, _names=None, lazy=False, max_part_bytes=None):
+    # lazy counterpart of extract_emails: one parsed email at a time, scanning the
+    # directory itself when no names are given
+    if _names is None:
+        _names = (entry.name for entry in os.scandir(_path) if entry.is_file() and entry.name != 'cmds')
+    for name in _names:
+        yield parse_email_file(os.path.join(_path, name), lazy, max_part_bytes)
+
+# Mail stores read in place: a directory of message files, a Maildir, a tar archive or
+# an mbox file, any of them (or the files in a directory) gzip, bzip2 or xz compressed.
+# Messages are streamed one at a time, so a .tar.bz2 corpus can go straight into the
+# pipeline without being extracted to thousands of small files first.
+
+_COMPRESSION_MAGIC = ((b'\x1f\x8b', gzip.open), (b'BZh', bz2.open), (b'\xfd7zXZ\x00', lzma.open))
+
+def open_compressed(path):
+    # opens path for binary reading, decompressing by content rather than by extension
+    with open(path, 'rb') as fp:
+        magic = fp.read(6)
+    for prefix, opener in _COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return opener(path, 'rb')
+    return open(path, 'rb')
+
+def _iter_tar_messages(fp, label):
+    import tarfile
+    with tarfile.open(fileobj=fp, mode='r|') as tar:
+        for member in tar:
+            if member.isfile() and os.path.basename(member.name) != 'cmds':
+                yield '{}:{}'.format(label, member.name), tar.extractfile(member).read()
+
+def _iter_mbox_messages(fp, label):
+    # splits on "From " lines and drops them, like mailbox.mbox, so ids match its keys
+    key, lines = 0, None
+    for line in fp:
+        if line.startswith(b'From '):
+            if lines is not None:
+                yield '{}:{}'.format(label, key), _mbox_message(lines)
+                key += 1
+            lines = []
+        elif lines is not None:
+            lines.append(line)
+    if lines is not None:
+        yield '{}:{}'.format(label, key), _mbox_message(lines)
+
+def _mbox_message(lines):
+    # the blank line before the next "From " belongs to the separator
+    if lines and lines[-1] == b'\n':
+        lines = lines[:-1]
+    return b''.join(lines)
+
+def _sniff(path):
+    with open_compressed(path) as fp:
+        head = fp.read(512)
+    if head[257:262] == b'ustar':
+        return 'tar'
+    return 'mbox' if head.startswith(b'From ') else 'message'
+
+def _message_files(path):
+    # (name, file path) of every message of a directory; Maildir layout keeps them
+    # under cur/ and new/
+    subdirs = [os.path.join(path, sub) for sub in ('cur', 'new') if os.path.isdir(os.path.join(path, sub))]
+    for directory in subdirs or [path]:
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            if entry.is_file() and entry.name != 'cmds':
+                yield entry.name, entry.path
+
+def iter_messages(path):
+    # yields (message id, raw bytes) from any supported mail store
+    if os.path.isdir(path):
+        for name, filepath in _message_files(path):
+            with open_compressed(filepath) as fp:
+                yield name, fp.read()
+        return
+    label = os.path.basename(path)
+    kind = _sniff(path)
+    with open_compressed(path) as fp:
+        if kind == 'tar':
+            yield from _iter_tar_messages(fp, label)
+        elif kind == 'mbox':
+            yield from _iter_mbox_messages(fp, label)
+        else:
+            # a single (possibly compressed) message
+            yield label, fp.read()
+
+def iter_source_emails(path, lazy=False, max_part_bytes=None):
+    for _, raw in iter_messages(path):
+        yield parse_email_bytes(raw, lazy, max_part_bytes)
+
+def iter_source_batches(path, batch_size=500, lazy=False, max_part_bytes=None):
+    return iter_batches(iter_source_emails(path, lazy, max_part_bytes), batch_size)
+
+def object_array(items):
+    # np.array() would treat EmailMessage objects as sequences of headers
+    X = np.empty(len(items), dtype=object)
+    X[:] = items
+    return X
+
+def iter_batches(iterable, batch_size=500):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield object_array(batch)
+            batch = []
+    if batch:
+        yield object_array(batch)
+
+def iter_email_batches(_path, _names=None, batch_size=500, lazy=False, max_part_bytes=None):
+    return iter_batches(iter_emails(_path, _names, lazy, max_part_bytes), batch_size)
+
+def transform_batches(transformer, batches):
+    # only one batch of parsed emails is alive at a time; transformer must be fitted.
+    # Stem caches with a path are saved every save_every new stems and once at the end
+    stem_caches = [stem_cache for stem_cache in _stem_caches(transformer) if stem_cache.path is not None]
+    try:
+        for batch in batches:
+            yield transformer.transform(batch)
+            for stem_cache in stem_caches:
+                if stem_cache.unsaved >= stem_cache.save_every:
+                    stem_cache.save()
+    finally:
+        for stem_cache in stem_caches:
+            if stem_cache.dirty:
+                stem_cache.save()
+
+def _stem_caches(estimator):
+    # the stem caches of fitted word counters, also inside pipelines and unions
+    steps = getattr(estimator, 'steps', None) or getattr(estimator, 'transformer_list', None) or []
+    stem_caches = [stem_cache for _, step in steps for stem_cache in _stem_caches(step)]
+    stem_cache = getattr(getattr(estimator, 'normalizer_', None), 'stem_cache', None)
+    if stem_cache is not None:
+        stem_caches.append(stem_cache)
+    return stem_caches
+
+def transform_stream(transformer, batches):
+    return scipy.sparse.vstack(list(transform_batches(transformer, batches)), format='csr')
+
+# MIME analytics. mime_profile() reads an email's structure, content types, charsets,
+# body size and URL count in one walk, from the raw header values rather than through
+# policy.default's header parsing (which costs more than the rest of the walk), and
+# without recursion. CorpusStats sums profiles into distributions that merge across
+# pool workers, and structure_features() turns a profile into a few numeric features
+# to stack next to the word-count matrix.
+#
+#   stats = F.corpus_stats('data/spam', n_jobs=4)
+#   stats.structures.most_common(), stats.charsets, stats.to_json()
+#
+#   stats = F.CorpusStats()
+#   X = F.transform_stream(preprocess, F.iter_batches(stats.observe(F.iter_source_emails(path))))
+
+_URL_START = re.compile(rb'(?:https?://|www\.)', flags=re.I)
+_CHARSET_PARAM = re.compile(r'charset\s*=\s*"?([^";\s]+)', flags=re.I)
+
+def _raw_headers(part, names=('content-type', 'content-transfer-encoding', 'content-disposition')):
+    # first raw value of each header, unfolded, as Message.get() would see it
+    headers = {}
+    for name, value in part.raw_items():
+        name = name.lower()
+        if name in names and name not in headers:
+            headers[name] = str(value).replace('\r', '').replace('\n', '')
+    return headers
+
+def _decoded_body(payload, encoding):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8', 'surrogateescape')
+    try:
+        if encoding == 'base64':
+            return binascii.a2b_base64(payload)
+        if encoding == 'quoted-printable':
+            return binascii.a2b_qp(payload)
+    except (binascii.Error, ValueError):
+        pass
+    return payload
+
+def mime_profile(email):
+    # structure is the string structures_counter has always counted, e.g.
+    # "multipart(text/plain | application/octet-stream)"; body_bytes sums the encoded
+    # sizes of the leaf parts and urls counts http(s):// and www. in the decoded text parts
+    profile = {'structure': None, 'content_types': [], 'charsets': [], 'body_bytes': 0,
+               'urls': 0, 'depth': 0, 'attachments': 0}
+    pieces = []
+    # parts still to visit, and the ' | ' and ')' to emit between and after them
+    stack = [(email, 0)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            pieces.append(item)
             continue
+        part, depth = item
+        profile['depth'] = max(profile['depth'], depth)
+        payload = part.get_payload()
+        if isinstance(payload, list):
+            pieces.append('multipart(')
+            stack.append(')')
+            for i, subpart in enumerate(reversed(payload)):
+                if i:
+                    stack.append(' | ')
+                stack.append((subpart, depth + 1))
+            continue
+        headers = _raw_headers(part)
+        content_type = headers.get('content-type')
+        if content_type is None:
+            ctype = part.get_default_type()
+        else:
+            # Message.get_content_type() on the same value
+            ctype = content_type.partition(';')[0].strip().lower()
+            if ctype.count('/') != 1:
+                ctype = 'text/plain'
+        pieces.append(ctype)
+        profile['content_types'].append(ctype)
+        profile['body_bytes'] += len(payload) if payload is not None else 0
+        if ctype.startswith('text/'):
+            charset = _CHARSET_PARAM.search(content_type or '')
+            profile['charsets'].append(charset.group(1).lower() if charset else None)
+            if payload:
+                encoding = headers.get('content-transfer-encoding', '').strip().lower()
+                profile['urls'] += len(_URL_START.findall(_decoded_body(payload, encoding)))
+        if (ctype not in ('text/plain', 'text/html') or
+                headers.get('content-disposition', '').strip().lower().startswith('attachment')):
+            profile['attachments'] += 1
+    profile['structure'] = ''.join(pieces)
+    return profile
 
-def get_data_if_needed(spam, ham, date):
+STRUCTURE_FEATURES = ('parts', 'depth', 'attachments', 'has_text_plain', 'has_text_html', 'html_only',
+                      'non_ascii_charset', 'log_body_bytes', 'urls', 'log_urls')
+
+def structure_features(profile):
+    content_types = profile['content_types']
+    has_plain = 'text/plain' in content_types
+    has_html = 'text/html' in content_types
+    return [len(content_types), profile['depth'], profile['attachments'], has_plain, has_html,
+            has_html and not has_plain,
+            any(charset not in (None, 'us-ascii', 'ascii') for charset in profile['charsets']),
+            np.log1p(profile['body_bytes']), profile['urls'], np.log1p(profile['urls'])]
+
+
+class CorpusStats:
+    # distributions over a corpus: counts of MIME structures, leaf content types and
+    # text charsets, and histograms of body size and URL count (each email counted in
+    # the first bucket whose bound it does not exceed, as in PipelineProfiler)
     
-    def get_date(emailtype):  
-        uxtime = os.path.getmtime(os.path.join('data', emailtype))      
-        return(dt.datetime.fromtimestamp(uxtime).strftime('%Y%m%d'))
-    
-    if (os.path.isdir(os.path.join('data', spam)) and get_date(spam) == date) \
-    and (os.path.isdir(os.path.join('data', ham)) and get_date(ham) == date):
-        print('Data successfully downloaded.')
-    else: 
-        _spam = ''.join([date, '_', spam])
-        _ham = ''.join([date, '_', ham])
-        get_data(_spam, _ham, date)
-        
-def extract_emails(_path, _names):
+    SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, float('inf'))
+    URL_BUCKETS = (0, 1, 2, 5, 10, 20, 50, float('inf'))
+    
+    def __init__(self):
+        self.emails = 0
+        self.body_bytes = 0
+        self.urls = 0
+        self.structures = Counter()
+        self.content_types = Counter()
+        self.charsets = Counter()
+        self.size_buckets = [0] * len(self.SIZE_BUCKETS)
+        self.url_buckets = [0] * len(self.URL_BUCKETS)
+    
+    @staticmethod
+    def _bucket(buckets, bounds, value):
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                buckets[i] += 1
+                return
+    
+    def add_profile(self, profile):
+        self.emails += 1
+        self.body_bytes += profile['body_bytes']
+        self.urls += profile['urls']
+        self.structures[profile['structure']] += 1
+        self.content_types.update(profile['content_types'])
+        self.charsets.update(charset or 'none' for charset in profile['charsets'])
+        self._bucket(self.size_buckets, self.SIZE_BUCKETS, profile['body_bytes'])
+        self._bucket(self.url_buckets, self.URL_BUCKETS, profile['urls'])
+        return profile
+    
+    def add(self, email):
+        return self.add_profile(mime_profile(email))
+    
+    def observe(self, emails):
+        # passes emails through while adding them, so the stats come out of the
+        # ingestion pass itself (e.g. around iter_source_emails)
+        for email in emails:
+            self.add(email)
+            yield email
+    
+    def merge(self, other):
+        self.emails += other.emails
+        self.body_bytes += other.body_bytes
+        self.urls += other.urls
+        self.structures.update(other.structures)
+        self.content_types.update(other.content_types)
+        self.charsets.update(other.charsets)
+        self.size_buckets = [a + b for a, b in zip(self.size_buckets, other.size_buckets)]
+        self.url_buckets = [a + b for a, b in zip(self.url_buckets, other.url_buckets)]
+        return self
+    
+    def to_dict(self):
+        return {'emails': self.emails, 'body_bytes': self.body_bytes, 'urls': self.urls,
+                'structures': dict(self.structures.most_common()),
+                'content_types': dict(self.content_types.most_common()),
+                'charsets': dict(self.charsets.most_common()),
+                'size_buckets': dict(zip(map(str, self.SIZE_BUCKETS), self.size_buckets)),
+                'url_buckets': dict(zip(map(str, self.URL_BUCKETS), self.url_buckets))}
+    
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=4)
+
+def _corpus_stats_batch(sources):
+    # sources are file paths or raw messages; compat32 leaves headers as plain
+    # strings, the walk needs nothing more
+    stats = CorpusStats()
+    for source in sources:
+        if isinstance(source, str):
+            with open_compressed(source) as fp:
+                source = fp.read()
+        stats.add(email.message_from_bytes(source, policy=email.policy.compat32))
+    return stats
 
-    def parse_emails(filename):
-        with open(os.path.join(_path, filename), 'rb') as fp:
-            return(email.parser.BytesParser(policy=email.policy.default).parse(fp))   
-    return([parse_emails(filename=name) for name in _names])
+def corpus_stats(path, n_jobs=1, batch_size=256):
+    # one streaming pass over a directory, Maildir, mbox file or tar archive (see
+    # iter_messages); each pool task profiles a batch of messages and sends back its
+    # CorpusStats, merged here in completion order. Files of a directory are read by
+    # the workers, so only paths and partial aggregates go through the pool.
+    if os.path.isdir(path):
+        sources = (filepath for _, filepath in _message_files(path))
+    else:
+        sources = (raw for _, raw in iter_messages(path))
+    batches = iter_batches(sources, batch_size)
+    stats = CorpusStats()
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs == 1:
+        for batch in batches:
+            stats.merge(_corpus_stats_batch(batch))
+        return stats
+    with multiprocessing.Pool(n_jobs) as pool:
+        for partial in pool.imap_unordered(_corpus_stats_batch, batches):
+            stats.merge(partial)
+    return stats
 
 def structures_counter(emails):
- 
-    def get_structure(email):
+    return Counter(mime_profile(email)['structure'] for email in emails)
 
-        payload = email.get_payload()
-        if isinstance(payload, list):
-            return "multipart({})".format(" | ".join([
-                get_structure(sub_email)
-                for sub_email in payload
-            ]))
+
+def _email_structure_features(email):
+    return structure_features(mime_profile(email))
+
+class EmailStructureTransformer(BaseEstimator, TransformerMixin):
+    # STRUCTURE_FEATURES of each email as a dense float matrix, to combine with the
+    # word-count vectors, e.g. FeatureUnion([('words', preprocess_pipeline),
+    # ('structure', EmailStructureTransformer())])
+    
+    def __init__(self, n_jobs=1, chunksize=64):
+        self.n_jobs = n_jobs
+        self.chunksize = chunksize
+    
+    def fit(self, X, y=None):
+        return self
+    
+    def transform(self, X, y=None):
+        n_jobs = effective_n_jobs(self.n_jobs)
+        if n_jobs == 1:
+            rows = [_email_structure_features(email) for email in X]
         else:
-            return email.get_content_type()     
-    structures = Counter()
-    for email in emails:
-        structure = get_structure(email)
-        structures[structure] += 1
-    return structures
-
-def html_to_plaintext(html):
-    text = re.sub('<head.*?>.*?</head>', '', html, flags=re.M | re.S | re.I)
-    text = re.sub('<a\s.*?>', ' HYPERLINK ', text, flags=re.M | re.S | re.I)
-    text = re.sub('<.*?>', '', text, flags=re.M | re.S)
-    text = re.sub(r'(\s*\n)+', '\n', text, flags=re.M | re.S)
-    
-    return unescape(text)
-
-def email_to_text(email):    
+            with multiprocessing.Pool(n_jobs) as pool:
+                rows = pool.map(_email_structure_features, X, chunksize=self.chunksize)
+        return np.array(rows, dtype=np.float64).reshape(len(rows), len(STRUCTURE_FEATURES))
+    
+    def get_feature_names_out(self, input_features=None):
+        return np.array(STRUCTURE_FEATURES, dtype=object)
+
+# html_to_plaintext used to run non-greedy regexes ('<head.*?>.*?</head>', '<.*?>')
+# which rescan to the end of the text for every unclosed tag. The regexes below match
+# the same spans but with [^>]* in C, and only run up to the last '>' (or '</head>'):
+# past it no tag can be closed, and before it every opener finds its '>' at once, so
+# each pass is linear. The one opener left that could still rescan, a '<head' whose
+# '>' is the one of the last '</head>', sends _remove_head to a str.find scan
+_HEAD = re.compile(r'<head[^>]*>.*?</head>', flags=re.I | re.S)
+_HEAD_OPEN = re.compile('<head', flags=re.I)
+_HEAD_CLOSE = re.compile('</head>', flags=re.I)
+_ANCHOR = re.compile(r'<a\s[^>]*>', flags=re.I)
+_TAG = re.compile('<[^>]*>')
+_NEWLINE_RUNS = re.compile(r'(?<!\s)\s*\n')
+
+def _remove_head(html):
+    close = None
+    for close in _HEAD_CLOSE.finditer(html):
+        pass
+    if close is None:
+        return html
+    cut = close.end()
+    if _HEAD_OPEN.search(html, html.rfind('>', 0, close.start()) + 1, close.start()):
+        return _scan_remove_head(html)
+    return _HEAD.sub('', html[:cut]) + html[cut:]
+
+def _scan_remove_head(html):
+    pieces = []
+    pos = 0
+    while True:
+        match = _HEAD_OPEN.search(html, pos)
+        if match is None:
+            break
+        gt = html.find('>', match.end())
+        if gt == -1:
+            break
+        close = _HEAD_CLOSE.search(html, gt + 1)
+        if close is None:
+            break
+        pieces.append(html[pos:match.start()])
+        pos = close.end()
+    pieces.append(html[pos:])
+    return ''.join(pieces)
+
+def _sub_closed(pattern, replacement, html):
+    cut = html.rfind('>') + 1
+    return pattern.sub(replacement, html[:cut]) + html[cut:]
+
+def html_to_plaintext(html, max_length=None):
+    profiler = _profiler
+    if profiler is not None:
+        start = time.perf_counter()
+    if max_length is not None:
+        html = html[:max_length]
+    text = _remove_head(html)
+    text = _sub_closed(_ANCHOR, ' HYPERLINK ', text)
+    text = _sub_closed(_TAG, '', text)
+    # same as (\s*\n)+ but only tried at the start of a whitespace run
+    text = _NEWLINE_RUNS.sub('\n', text)
+    text = unescape(text)
+    
+    if profiler is not None:
+        profiler.record('html_to_plaintext', time.perf_counter() - start, nbytes=len(html))
+    return text
+
+def email_to_text(email, max_part_length=None):
+    # max_part_length caps how many characters of each text part are kept, and at most
+    # _ENCODED_BYTES_PER_CHAR times as many bytes of its encoded payload are decoded
+    profiler = _profiler
+    if profiler is None:
+        return _email_to_text(email, max_part_length)
+    start = time.perf_counter()
+    text = _email_to_text(email, max_part_length)
+    profiler.record('email_to_text', time.perf_counter() - start, nbytes=len(text or ''))
+    return text
+
+# enough encoded bytes for any character: up to 4 bytes (more with escape-based
+# charsets) times 3 for quoted-printable, plus soft line breaks
+_ENCODED_BYTES_PER_CHAR = 32
+
+def _truncated_part(part, max_bytes):
+    # a copy of the part with its payload cut before transfer and charset decoding;
+    # _payload is the raw text, get_payload() already decodes 8bit parts
+    payload = part._payload
+    if not isinstance(payload, str) or len(payload) <= max_bytes:
+        return part
+    payload = payload[:max_bytes]
+    if str(part.get('content-transfer-encoding', '')).strip().lower() == 'base64':
+        # whole 4-character groups only, a partial one fails the base64 decoding
+        payload = payload.rstrip()
+        payload = payload[:len(payload) - (len(payload) - payload.count('\n') - payload.count('\r')) % 4]
+    part = copy.copy(part)
+    part.set_payload(payload)
+    return part
+
+def _email_to_text(email, max_part_length):
     html = None
     for part in email.walk():
         ctype = part.get_content_type()
         if not ctype in ("text/plain", "text/html"):
             continue
+        if max_part_length is not None:
+            part = _truncated_part(part, max_part_length * _ENCODED_BYTES_PER_CHAR)
         try:
             content = part.get_content()
         except: # in case of encoding issues
             content = str(part.get_payload())
+        if max_part_length is not None:
+            content = content[:max_part_length]
         if ctype == "text/plain":
             return content
         else:
@@ -123,11 +935,435 @@ def email_to_text(email):
     if html:
         return html_to_plaintext(html)
 
+
+class StemCache:
+    # bounded LRU cache of surface form -> stem, optionally persisted as json
+    # (e.g. processed_data/stem_cache.json next to the vocabulary files); without a
+    # stemmer a PorterStemmer is created on the first miss, so a warm cache loaded
+    # from disk or a pickle may never need one. Nothing is saved implicitly: see
+    # transform_batches and save_stem_cache. A pickled cache forgets its path, so a
+    # model loaded elsewhere never writes to the training machine's file. Pool workers
+    # set new_stems to a list so their misses can be merged back with update()
+    
+    def __init__(self, stemmer=None, maxsize=100000, path=None, save_every=1000):
+        self.stemmer = stemmer
+        self.maxsize = maxsize
+        self.path = path
+        self.save_every = save_every
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.unsaved = 0
+        self.new_stems = None
+        self._stems = OrderedDict()
+        if path is not None:
+            self.load(path)
+    
+    def stem(self, word):
+        try:
+            stemmed_word = self._stems[word]
+            self._stems.move_to_end(word)
+            self.hits += 1
+            return stemmed_word
+        except KeyError:
+            pass
+        self.misses += 1
+        self.dirty = True
+        self.unsaved += 1
+        if self.stemmer is None:
+            from nltk.stem import PorterStemmer
+            self.stemmer = PorterStemmer()
+        stemmed_word = self.stemmer.stem(word)
+        self._stems[word] = stemmed_word
+        if self.maxsize is not None and len(self._stems) > self.maxsize:
+            self._stems.popitem(last=False)
+        if self.new_stems is not None:
+            self.new_stems.append((word, stemmed_word))
+        return stemmed_word
+    
+    def take_new_stems(self):
+        new_stems, self.new_stems = self.new_stems, []
+        return new_stems
+    
+    def update(self, stems):
+        # merge (word, stem) pairs computed elsewhere, e.g. by pool workers
+        for word, stemmed_word in stems:
+            if word in self._stems:
+                continue
+            self._stems[word] = stemmed_word
+            self.dirty = True
+            self.unsaved += 1
+        if self.maxsize is not None:
+            while len(self._stems) > self.maxsize:
+                self._stems.popitem(last=False)
+        return self
+    
+    def __len__(self):
+        return len(self._stems)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._stems), 'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+    
+    def load(self, path):
+        try:
+            with open(path, 'r') as fp:
+                stems = json.load(fp)
+        except FileNotFoundError:
+            return self
+        if self.maxsize is not None:
+            stems = dict(list(stems.items())[-self.maxsize:]) if self.maxsize > 0 else {}
+        self._stems.update(stems)
+        return self
+    
+    def save(self, path=None):
+        path = path or self.path
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(self._stems, fp)
+        os.replace(path + '.tmp', path)
+        self.dirty = False
+        self.unsaved = 0
+        return path
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['stemmer'] = None
+        state['path'] = None
+        return state
+    
+    
+# Tokenizers for remove_stopwords=True (otherwise tokens are plain \w+ runs or
+# whitespace splits and no tokenizer is involved):
+#   'nltk'   word_tokenize and the NLTK stopwords corpus; needs the punkt and stopwords data
+#   'regex'  no NLTK at all: ENGLISH_STOP_WORDS and _regex_word_tokenize below
+#   'auto'   'nltk' when its data is installed, 'regex' otherwise
+
+ENGLISH_STOP_WORDS = frozenset("""
+i me my myself we our ours ourselves you you're you've you'll you'd your yours yourself
+yourselves he him his himself she she's her hers herself it it's its itself they them
+their theirs themselves what which who whom this that that'll these those am is are was
+were be been being have has had having do does did doing a an the and but if or because
+as until while of at by for with about against between into through during before after
+above below to from up down in out on off over under again further then once here there
+when where why how all any both each few more most other some such no nor not only own
+same so than too very s t can will just don don't should should've now d ll m o re ve y
+ain aren aren't couldn couldn't didn didn't doesn doesn't hadn hadn't hasn hasn't haven
+haven't isn isn't ma mightn mightn't mustn mustn't needn needn't shan shan't shouldn
+shouldn't wasn wasn't weren weren't won won't wouldn wouldn't he'd he'll he's i'd i'll
+i'm i've it'd it'll she'd she'll they'd they'll they're they've we'd we'll we're we've
+""".split())
+
+TOKENIZERS = ('nltk', 'regex', 'auto')
+
+# word_tokenize splits these words further even without apostrophes (Treebank's
+# CONTRACTIONS2 rules); ('wanna' only before whitespace, which padding always provides)
+_SPLIT_WORDS = {'cannot': 3, 'gimme': 3, 'gonna': 3, 'gotta': 3, 'lemme': 3, 'wanna': 3}
+_WORD_OR_SYMBOL = re.compile(r"\w+|[^\w\s]")
+
+def _regex_word_tokenize(text, punctuation_removed=True):
+    # word_tokenize without punkt: on punctuation-free text (remove_punctuation=True) it
+    # gives the same tokens; with punctuation each symbol is its own token, close to but
+    # not exactly Treebank's rules
+    words = text.split() if punctuation_removed else _WORD_OR_SYMBOL.findall(text)
+    tokens = []
+    for word in words:
+        split = _SPLIT_WORDS.get(word.lower())
+        if split is None:
+            tokens.append(word)
+        else:
+            tokens += [word[:split], word[split:]]
+    return tokens
+
+def resolve_tokenizer(tokenizer):
+    if tokenizer not in TOKENIZERS:
+        raise ValueError('tokenizer must be one of {}, got {!r}'.format(TOKENIZERS, tokenizer))
+    if tokenizer != 'auto':
+        return tokenizer
+    import nltk
+    try:
+        nltk.data.find('corpora/stopwords')
+        try:
+            nltk.data.find('tokenizers/punkt_tab')
+        except LookupError:
+            nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        return 'regex'
+    return 'nltk'
+
+
+# a regex that only matches literal text: escaped punctuation and ordinary characters
+_LITERAL = re.compile(r'(?:\\[^0-9A-Za-z]|[^\\|()\[\]{}*+?.^$])+')
+_LITERAL_ALTERNATION = re.compile(r'{0}(?:\|{0})*'.format(_LITERAL.pattern))
+
+class TextNormalizer:
+    # holds the URL extractor, stemmer, stopword set and compiled regexes so they are
+    # built once per transformer instead of once per email. The URL extractor and the
+    # stemmer are built on first use and dropped on pickling; the stopword set is kept,
+    # so an unpickled normalizer never reads the NLTK stopwords corpus.
+    
+    _resources = ('_url_extractor',)
+    
+    def __init__(self, remove_stopwords, lower_case=True, remove_punctuation=True,
+                 replace_urls=True, replace_numbers=True, stemming=True,
+                 stem_cache_size=100000, stem_cache_path=None, max_part_length=None, tokenizer='nltk'):
+        self.remove_stopwords = remove_stopwords
+        self.lower_case = lower_case
+        self.remove_punctuation = remove_punctuation
+        self.replace_urls = replace_urls
+        self.replace_numbers = replace_numbers
+        self.stemming = stemming
+        self.stem_cache_size = stem_cache_size
+        self.stem_cache_path = stem_cache_path
+        self.max_part_length = max_part_length
+        self.tokenizer = tokenizer
+        self._tokenizer = resolve_tokenizer(tokenizer) if remove_stopwords else None
+        if not self.remove_stopwords:
+            self.stop_words = None
+        elif self._tokenizer == 'nltk':
+            from nltk.corpus import stopwords
+            self.stop_words = set(stopwords.words("english"))
+        else:
+            self.stop_words = set(ENGLISH_STOP_WORDS)
+        self._build()
+        if self.stemming:
+            self.stem_cache = StemCache(maxsize=stem_cache_size, path=stem_cache_path)
+        
+    def _build(self):
+        self.number_pattern = re.compile(r'\d+(?:\.\d*(?:[eE]\d+))?')
+        self.punctuation_pattern = re.compile(r'\W+', flags=re.M)
+        self.token_pattern = re.compile(r'\w+')
+        self._url_extractor = None
+    
+    @property
+    def url_extractor(self):
+        if self._url_extractor is None and self.replace_urls:
+            self._url_extractor = self._make_url_extractor()
+        return self._url_extractor
+        
+    @staticmethod
+    def _make_url_extractor():
+        # URLExtract scans for a ~1500-way alternation of TLDs at every position of the
+        # text; a lookahead on the possible first characters lets the regex engine skip
+        # the rest without changing what is matched. Only done while the pattern is a
+        # plain alternation of literals, otherwise the stock regex is kept
+        import urlextract
+        url_extractor = urlextract.URLExtract()
+        tlds_re = getattr(url_extractor, '_tlds_re', None)
+        if tlds_re is not None and _LITERAL_ALTERNATION.fullmatch(tlds_re.pattern):
+            first_chars = set(re.escape(literal[1] if literal[0] == '\\' else literal[0])
+                              for literal in _LITERAL.findall(tlds_re.pattern))
+            url_extractor._tlds_re = re.compile('(?=[{}])(?:{})'.format(''.join(sorted(first_chars)),
+                                                                       tlds_re.pattern), tlds_re.flags)
+        return url_extractor
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._resources + ('number_pattern', 'punctuation_pattern', 'token_pattern'):
+            state.pop(name, None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build()
+        
+    def _replace_urls_and_numbers(self, text):
+        # the legacy chain: each url replaced everywhere, longest first, then numbers.
+        # Deliberately not one regex: an alternation only prefers the longest url among
+        # matches starting at the same position, and lets a number eat the start of a
+        # url that follows digits, so its tokens would differ
+        if self.replace_urls:
+            profiler = _profiler
+            if profiler is not None:
+                start = time.perf_counter()
+            urls = sorted(set(self.url_extractor.find_urls(text)), key=len, reverse=True)
+            if profiler is not None:
+                profiler.record('url_extraction', time.perf_counter() - start, nbytes=len(text), ntokens=len(urls))
+            for url in urls:
+                text = text.replace(url, ' URL ')
+        return self.number_pattern.sub('NUMBER', text) if self.replace_numbers else text
+    
+    def tokenize(self, text):
+        profiler = _profiler
+        if profiler is None:
+            return self._tokenize(text)
+        start = time.perf_counter()
+        tokens = self._tokenize(text)
+        # includes url_extraction, which is also reported on its own
+        profiler.record('tokenize', time.perf_counter() - start, nbytes=len(text), ntokens=len(tokens))
+        return tokens
+    
+    def _tokenize(self, text):
+        if self.lower_case:
+            text = text.lower()
+        
+        text = self._replace_urls_and_numbers(text)
+        
+        if self.remove_stopwords:
+            # word_tokenize splits some words further (e.g. "cannot"), keep its exact input
+            if self.remove_punctuation:
+                text = self.punctuation_pattern.sub(' ', text)
+            if self._tokenizer == 'nltk':
+                from nltk.tokenize import word_tokenize
+                tokens = word_tokenize(text)
+            else:
+                tokens = _regex_word_tokenize(text, self.remove_punctuation)
+            return [word for word in tokens if not word in self.stop_words]
+        # maximal runs of word characters are exactly what \W+ -> ' ' then split() leaves
+        if self.remove_punctuation:
+            return self.token_pattern.findall(text)
+        return text.split()
+    
+    def normalize_email(self, email):
+        return self.normalize(email_to_text(email, self.max_part_length) or "")
+    
+    def normalize(self, text):
+        word_counts = Counter(self.tokenize(text))
+            
+        if self.stemming:
+            profiler = _profiler
+            if profiler is not None:
+                start = time.perf_counter()
+            stemmed_word_counts = Counter()
+            stem = self.stem_cache.stem
+            for word, count in word_counts.items():
+                stemmed_word = stem(word)
+                stemmed_word_counts[stemmed_word] += count
+            if profiler is not None:
+                profiler.record('stemming', time.perf_counter() - start, ntokens=len(word_counts))
+            word_counts = stemmed_word_counts
+        return word_counts
+
+
+class TokenIndex:
+    # interns tokens to consecutive integer ids; ids never change once assigned, so
+    # TokenCounts produced earlier stay valid as the index grows
+    
+    def __init__(self):
+        self.ids = {}
+        self._tokens = []
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def intern(self, words):
+        ids = self.ids
+        setdefault = ids.setdefault
+        return [setdefault(word, len(ids)) for word in words]
+    
+    @property
+    def tokens(self):
+        # id -> token, extended lazily from the dict's insertion order
+        if len(self._tokens) < len(self.ids):
+            self._tokens.extend(itertools.islice(self.ids, len(self._tokens), None))
+        return self._tokens
+    
+    def __getstate__(self):
+        return {'ids': self.ids}
+    
+    def __setstate__(self, state):
+        self.ids = state['ids']
+        self._tokens = []
+
+
+class TokenCounts:
+    # compact replacement for an object array of Counters: document i holds the token
+    # ids ids[offsets[i]:offsets[i + 1]] with their counts at the same positions, in the
+    # Counter's key order. Indexing with an int gives that document's Counter back,
+    # slices and index arrays give a TokenCounts, and iterating yields Counters, so
+    # code written for Counters keeps working while the vectorizers use the arrays.
+    
+    def __init__(self, ids, counts, offsets, index):
+        self.ids = ids
+        self.counts = counts
+        self.offsets = offsets
+        self.index = index
+    
+    @classmethod
+    def from_counters(cls, X, index=None):
+        index = TokenIndex() if index is None else index
+        ids = array.array('i')
+        counts = array.array('i')
+        offsets = array.array('q', [0])
+        for word_counts in X:
+            ids.extend(index.intern(word_counts))
+            counts.extend(word_counts.values())
+            offsets.append(len(ids))
+        return cls(np.frombuffer(ids, dtype=np.int32), np.frombuffer(counts, dtype=np.int32),
+                   np.frombuffer(offsets, dtype=np.int64), index)
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+    
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.counts.nbytes + self.offsets.nbytes
+    
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError('document index out of range')
+            start, end = self.offsets[key], self.offsets[key + 1]
+            tokens = self.index.tokens
+            return Counter(dict(zip([tokens[i] for i in self.ids[start:end].tolist()],
+                                    self.counts[start:end].tolist())))
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(len(self))
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            return TokenCounts(self.ids[offsets[0]:offsets[-1]], self.counts[offsets[0]:offsets[-1]],
+                               offsets - offsets[0], self.index)
+        # index array, boolean mask or stepped slice: gather the selected documents
+        rows = np.arange(len(self))[key]
+        lengths = self.lengths[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(self.offsets[rows] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return TokenCounts(self.ids[positions], self.counts[positions], offsets, self.index)
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    def to_counters(self):
+        return np.array(list(self))
+    
+    def total_counts(self, clip=None):
+        # per-token sums over all documents, clipping each document's count at clip
+        counts = self.counts if clip is None else np.minimum(self.counts, clip)
+        return np.bincount(self.ids, weights=counts, minlength=len(self.index)).astype(np.int64)
+    
+    def first_seen(self):
+        # (ids present, position of their first occurrence), ids ascending; assigning in
+        # reverse leaves the earliest position, without sorting every occurrence
+        first = np.full(len(self.index), len(self.ids), dtype=np.int64)
+        first[self.ids[::-1]] = np.arange(len(self.ids) - 1, -1, -1)
+        token_ids = np.flatnonzero(first < len(self.ids))
+        return token_ids, first[token_ids]
     
+    def column_map(self, vocabulary_):
+        # token id -> vocabulary column, 0 for out-of-vocabulary tokens
+        columns = np.zeros(len(self.index), dtype=np.int32)
+        get = self.index.ids.get
+        for word, column in vocabulary_.items():
+            token_id = get(word)
+            if token_id is not None:
+                columns[token_id] = column
+        return columns
+
+
 class EmailToWordCounterTransformer_revised(BaseEstimator, TransformerMixin):
 
     def __init__(self, remove_stopwords, strip_headers=True, lower_case=True, remove_punctuation=True,
-                 replace_urls=True, replace_numbers=True, stemming=True):
+                 replace_urls=True, replace_numbers=True, stemming=True,
+                 stem_cache_size=100000, stem_cache_path=None, max_part_length=None, n_jobs=1, chunksize=64,
+                 output='counters', tokenizer='nltk'):
         self.remove_stopwords = remove_stopwords
         self.strip_headers = strip_headers
         self.lower_case = lower_case
@@ -135,107 +1371,965 @@ class EmailToWordCounterTransformer_revised(BaseEstimator, TransformerMixin):
         self.replace_urls = replace_urls
         self.replace_numbers = replace_numbers
         self.stemming = stemming
+        self.stem_cache_size = stem_cache_size
+        self.stem_cache_path = stem_cache_path
+        self.max_part_length = max_part_length
+        self.n_jobs = n_jobs
+        self.chunksize = chunksize
+        self.output = output
+        self.tokenizer = tokenizer
+    
+    # parameters that change speed or memory but never the Counters produced
+    _runtime_params = ('stem_cache_size', 'stem_cache_path', 'n_jobs', 'chunksize', 'output')
+    
+    def normalization_params(self):
+        params = {key: value for key, value in self.get_params().items() if key not in self._runtime_params}
+        # the tokenizer only matters with remove_stopwords; leaving out the default keeps
+        # older cache keys valid
+        tokenizer = resolve_tokenizer(self.tokenizer) if self.remove_stopwords else 'nltk'
+        if tokenizer == 'nltk':
+            params.pop('tokenizer')
+        else:
+            params['tokenizer'] = tokenizer
+        return params
+    
+    def _make_normalizer(self):
+        return TextNormalizer(remove_stopwords=self.remove_stopwords, lower_case=self.lower_case,
+                              remove_punctuation=self.remove_punctuation, replace_urls=self.replace_urls,
+                              replace_numbers=self.replace_numbers, stemming=self.stemming,
+                              stem_cache_size=self.stem_cache_size, stem_cache_path=self.stem_cache_path,
+                              max_part_length=self.max_part_length, tokenizer=self.tokenizer)
+    
+    def _get_normalizer(self):
+        # rebuild if parameters changed through set_params since the last fit
+        normalizer = getattr(self, 'normalizer_', None)
+        params = self.get_params()
+        if normalizer is None or any(getattr(normalizer, key) != value for key, value in params.items()
+                                     if hasattr(normalizer, key)):
+            self.normalizer_ = self._make_normalizer()
+        return self.normalizer_
     
     def fit(self, X, y=None):
+        self._get_normalizer()
+        if not hasattr(self, 'token_index_'):
+            self.token_index_ = TokenIndex()
         return self
     
+    def partial_fit(self, X, y=None):
+        return self.fit(X, y)
+    
     def transform(self, X, y=None):        
-        X_transformed = []
+        # output='counters' returns an object array of Counters, output='token_ids' a
+        # TokenCounts whose ids index into token_index_, shared by every transform call
+        normalizer = self._get_normalizer()
+        n_jobs = effective_n_jobs(self.n_jobs)
         
-        for email in X:
-            text = email_to_text(email) or ""
-            
-            if self.lower_case:
-                text = text.lower()
-                
-            if self.replace_urls:
-                url_extractor = urlextract.URLExtract()
-                urls = list(set(url_extractor.find_urls(text)))
-                urls.sort(key=lambda url: len(url), reverse=True)
-                for url in urls:
-                    text = text.replace(url, " URL ")
-                    
-            if self.replace_numbers:
-                text = re.sub(r'\d+(?:\.\d*(?:[eE]\d+))?', 'NUMBER', text)
-                
-            if self.remove_punctuation:
-                text = re.sub(r'\W+', ' ', text, flags=re.M)
-            
-            if self.remove_stopwords:
-                stop_words = set(stopwords.words("english"))
-                word_tokens = word_tokenize(text)
-                text = [word for word in word_tokens if not word in stop_words]
-                word_counts = Counter(text)
-            else: 
-                word_counts = Counter(text.split())
-    
-            if self.stemming:        
-                stemmer = nltk.PorterStemmer()
-                stemmed_word_counts = Counter()
-                for word, count in word_counts.items():
-                    stemmed_word = stemmer.stem(word)                        
-                    stemmed_word_counts[stemmed_word] += count
-                word_counts = stemmed_word_counts       
-            X_transformed.append(word_counts)
+        if n_jobs == 1:
+            X_transformed = (normalizer.normalize_email(email) for email in X)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(n_jobs, initializer=_init_normalizer_worker, initargs=(normalizer,))
+            X_transformed = _merge_worker_stems(pool.imap(_email_to_word_counts, X, chunksize=self.chunksize),
+                                                normalizer)
+        try:
+            if self.output == 'token_ids':
+                if not hasattr(self, 'token_index_'):
+                    self.token_index_ = TokenIndex()
+                X_transformed = TokenCounts.from_counters(X_transformed, self.token_index_)
+            else:
+                X_transformed = np.array(list(X_transformed))
+        finally:
+            if pool is not None:
+                pool.terminate()
             
-        return np.array(X_transformed)
+        return X_transformed
+    
+    def save_stem_cache(self):
+        # persist newly stemmed words so the next run starts warm
+        normalizer = getattr(self, 'normalizer_', None)
+        stem_cache = getattr(normalizer, 'stem_cache', None)
+        if stem_cache is not None and stem_cache.path is not None and stem_cache.dirty:
+            return stem_cache.save()
+
+
+# process pool workers: the normalizer is sent once per worker through the pool
+# initializer rather than once per task
+_worker_normalizer = None
+
+def _init_normalizer_worker(normalizer):
+    global _worker_normalizer
+    _worker_normalizer = normalizer
+    stem_cache = getattr(normalizer, 'stem_cache', None)
+    if stem_cache is not None:
+        stem_cache.new_stems = []
+
+def _email_to_word_counts(email):
+    # the stems this task added travel back with its Counter
+    word_counts = _worker_normalizer.normalize_email(email)
+    stem_cache = getattr(_worker_normalizer, 'stem_cache', None)
+    return word_counts, stem_cache.take_new_stems() if stem_cache is not None else None
+
+def _merge_worker_stems(results, normalizer):
+    stem_cache = getattr(normalizer, 'stem_cache', None)
+    for word_counts, new_stems in results:
+        if new_stems:
+            stem_cache.update(new_stems)
+        yield word_counts
+
+def _email_file_to_word_counts(filepath, lazy=False, max_part_bytes=None):
+    return _email_to_word_counts(parse_email_file(filepath, lazy, max_part_bytes))
+
+def extract_word_counts(_path, _names, transformer, n_jobs=1, chunksize=64, cache=None, lazy=False, max_part_bytes=None):
+    # parse, extract text and tokenize in the workers so only the Counters travel
+    # back to the parent process; with a WordCountCache only new or changed emails
+    # are processed
+    filepaths = [os.path.join(_path, name) for name in _names]
+    normalizer = transformer._get_normalizer()
+    
+    if cache is not None:
+        loader_params = {'lazy': True, 'max_part_bytes': max_part_bytes} if lazy else None
+        params_key = cache.params_key(transformer, loader_params)
+        content_keys = []
+        for filepath in filepaths:
+            with open(filepath, 'rb') as fp:
+                content_keys.append(cache.content_key(fp.read()))
+        cached = cache.get_many(content_keys, params_key)
+        todo = [i for i, key in enumerate(content_keys) if key not in cached]
+    else:
+        todo = range(len(filepaths))
+    
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs == 1:
+        computed = [normalizer.normalize_email(parse_email_file(filepaths[i], lazy, max_part_bytes)) for i in todo]
+    else:
+        to_word_counts = functools.partial(_email_file_to_word_counts, lazy=lazy, max_part_bytes=max_part_bytes)
+        with multiprocessing.Pool(n_jobs, initializer=_init_normalizer_worker, initargs=(normalizer,)) as pool:
+            computed = list(_merge_worker_stems(pool.map(to_word_counts, [filepaths[i] for i in todo],
+                                                         chunksize=chunksize), normalizer))
+    transformer.save_stem_cache()
+    
+    if cache is None:
+        return(np.array(computed))
+    cache.put_many([(content_keys[i], word_counts) for i, word_counts in zip(todo, computed)], params_key)
+    for i, word_counts in zip(todo, computed):
+        cached[content_keys[i]] = word_counts
+    return(np.array([cached[key] for key in content_keys]))
+
+
+class WordCountCache:
+    # per-document cache of word Counters in sqlite, keyed by the sha256 of the raw email
+    # bytes and of the transformer's normalization parameters; least recently used
+    # entries are evicted once the stored Counters exceed max_bytes
+    
+    def __init__(self, path=os.path.join('processed_data', 'word_counts.sqlite'), max_bytes=512 * 2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+    
+    @property
+    def connection(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS word_counts (content_key TEXT, params_key TEXT, '
+                                     'value BLOB, size INTEGER, last_used REAL, '
+                                     'PRIMARY KEY (content_key, params_key))')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS word_counts_last_used ON word_counts (last_used)')
+        return self._connection
+    
+    @staticmethod
+    def content_key(raw):
+        return hashlib.sha256(raw).hexdigest()
+    
+    @staticmethod
+    def params_key(transformer, loader_params=None):
+        # loader_params: parsing options that change the extracted text (lazy MIME pruning)
+        params = dict(transformer.normalization_params(), **(loader_params or {}))
+        params = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(params.encode('utf-8')).hexdigest()
+    
+    def get_many(self, content_keys, params_key):
+        found = {}
+        unique_keys = list(set(content_keys))
+        # stay under sqlite's limit on bound parameters
+        for start in range(0, len(unique_keys), 500):
+            keys = unique_keys[start:start + 500]
+            rows = self.connection.execute(
+                'SELECT content_key, value FROM word_counts WHERE params_key = ? AND content_key IN ({})'.format(
+                    ','.join('?' * len(keys))), [params_key] + keys)
+            for content_key, value in rows:
+                found[content_key] = pickle.loads(value)
+        if found:
+            now = time.time()
+            with self.connection:
+                self.connection.executemany('UPDATE word_counts SET last_used = ? WHERE content_key = ? AND params_key = ?',
+                                            [(now, key, params_key) for key in found])
+        self.hits += sum(key in found for key in content_keys)
+        self.misses += sum(key not in found for key in content_keys)
+        return found
+    
+    def put_many(self, items, params_key):
+        now = time.time()
+        rows = []
+        for content_key, word_counts in items:
+            value = pickle.dumps(word_counts, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((content_key, params_key, value, len(value), now))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO word_counts VALUES (?, ?, ?, ?, ?)', rows)
+        self.evict()
+    
+    def size(self):
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM word_counts').fetchone()[0]
+    
+    def evict(self):
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        evicted = 0
+        with self.connection:
+            rows = self.connection.execute('SELECT rowid, size FROM word_counts ORDER BY last_used')
+            rowids = []
+            for rowid, size in rows:
+                if evicted >= excess:
+                    break
+                rowids.append((rowid,))
+                evicted += size
+            self.connection.executemany('DELETE FROM word_counts WHERE rowid = ?', rowids)
+        return len(rowids)
+    
+    def stats(self):
+        entries = self.connection.execute('SELECT COUNT(*) FROM word_counts').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {'entries': entries, 'bytes': self.size(), 'max_bytes': self.max_bytes, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+    
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+
+def word_counts_to_csr(X, vocabulary_, n_features, dtype=np.int64):
+    # builds indptr/indices/data directly instead of going through COO; out of
+    # vocabulary words are summed into a single column 0 entry per row
+    # (X may also be a TokenCounts, whose ids are mapped to columns in one gather)
+    profiler = _profiler
+    if profiler is not None:
+        start = time.perf_counter()
+    if isinstance(X, TokenCounts):
+        lengths = X.lengths
+        nnz = len(X.ids)
+        cols = X.column_map(vocabulary_)[X.ids]
+        counts = X.counts.astype(dtype)
+    else:
+        lengths = np.fromiter(map(len, X), dtype=np.int64, count=len(X))
+        nnz = int(lengths.sum())
+        get = vocabulary_.get
+        cols = np.fromiter((get(word, 0) for word_count in X for word in word_count),
+                           dtype=np.int32, count=nnz)
+        counts = np.fromiter((count for word_count in X for count in word_count.values()),
+                             dtype=dtype, count=nnz)
+    rows = np.repeat(np.arange(len(X)), lengths)
+    
+    in_vocab = cols != 0
+    oov_counts = np.zeros(len(X), dtype=dtype)
+    np.add.at(oov_counts, rows[~in_vocab], counts[~in_vocab])
+    has_oov = (oov_counts != 0).astype(np.int64)
+    in_vocab_rows = rows[in_vocab]
+    in_vocab_lengths = np.bincount(in_vocab_rows, minlength=len(X))
+    
+    indptr = np.zeros(len(X) + 1, dtype=np.int64)
+    np.cumsum(in_vocab_lengths + has_oov, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    data = np.empty(indptr[-1], dtype=dtype)
+    
+    # column 0 goes first in its row, in-vocabulary words follow in input order
+    oov_rows = np.flatnonzero(has_oov)
+    indices[indptr[oov_rows]] = 0
+    data[indptr[oov_rows]] = oov_counts[oov_rows]
+    in_vocab_starts = np.zeros(len(X), dtype=np.int64)
+    np.cumsum(in_vocab_lengths[:-1], out=in_vocab_starts[1:])
+    rank = np.arange(len(in_vocab_rows)) - in_vocab_starts[in_vocab_rows]
+    positions = indptr[in_vocab_rows] + has_oov[in_vocab_rows] + rank
+    indices[positions] = cols[in_vocab]
+    data[positions] = counts[in_vocab]
+    
+    X_transformed = csr_matrix((data, indices, indptr), shape=(len(X), n_features))
+    X_transformed.sort_indices()
+    if profiler is not None:
+        profiler.record('vectorize', time.perf_counter() - start, ntokens=nnz)
+    return X_transformed
+
+
+def total_word_counts(X, clip=10):
+    # corpus-wide counts with each email's count of a word capped at clip, in order of
+    # first appearance (the order most_common() breaks ties by)
+    if not isinstance(X, TokenCounts):
+        total_count = Counter()
+        for word_count in X:
+            for word, count in word_count.items():
+                total_count[word] += min(count, clip)
+        return total_count
+    totals = X.total_counts(clip)
+    token_ids, first_seen = X.first_seen()
+    token_ids = token_ids[np.argsort(first_seen, kind='stable')]
+    tokens = X.index.tokens
+    return Counter(dict(zip([tokens[i] for i in token_ids.tolist()], totals[token_ids].tolist())))
+
+
+# Vocabulary selection. Term statistics are accumulated with bincount over token ids
+# (Counters are interned into a TokenCounts first) and the top vocabulary_size terms
+# are picked with argpartition instead of sorting every term. Rankings:
+#   'frequency'         capped term counts, as Counter.most_common() orders them
+#   'chi2'              chi-squared of term presence against the class, max over classes
+#   'information_gain'  reduction of class entropy from knowing the term's presence
+# Ties are broken by first appearance in X, so 'frequency' selects exactly the
+# vocabulary the Counter-based fit did.
+
+RANKINGS = ('frequency', 'chi2', 'information_gain')
+
+def _entropy(p):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.where(p > 0, p * np.log2(p), 0).sum(axis=0)
+
+def term_scores(X, y=None, ranking='frequency', clip=10):
+    # returns (token ids present in X, their scores, their capped counts, first position in X)
+    if ranking not in RANKINGS:
+        raise ValueError('ranking must be one of {}, got {!r}'.format(RANKINGS, ranking))
+    if not isinstance(X, TokenCounts):
+        X = TokenCounts.from_counters(X)
+    token_ids, first_seen = X.first_seen()
+    counts = X.total_counts(clip)[token_ids]
+    if ranking == 'frequency':
+        return token_ids, counts, counts, first_seen
+    if y is None:
+        raise ValueError("ranking='{}' needs the labels y".format(ranking))
+    
+    # per-class document frequencies: each id occurs at most once per document
+    classes, y_index = np.unique(np.asarray(y), return_inverse=True)
+    token_class = np.repeat(y_index, X.lengths)
+    n_tokens = len(X.index)
+    class_df = np.vstack([np.bincount(X.ids[token_class == c], minlength=n_tokens)[token_ids]
+                          for c in range(len(classes))]).astype(np.float64)
+    df = class_df.sum(axis=0)
+    n_docs = float(len(X))
+    class_docs = np.bincount(y_index, minlength=len(classes)).astype(np.float64)[:, None]
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if ranking == 'chi2':
+            # 2x2 table per class: a = term & class, b = term & other, c = class without term
+            a = class_df
+            b = df - a
+            c = class_docs - a
+            d = n_docs - class_docs - b
+            chi2 = n_docs * (a * d - b * c) ** 2 / ((a + c) * (b + d) * (a + b) * (c + d))
+            scores = np.nan_to_num(chi2, nan=0.0, posinf=0.0).max(axis=0)
+        else:
+            p_term = df / n_docs
+            class_given_term = class_df / df
+            class_given_no_term = (class_docs - class_df) / (n_docs - df)
+            scores = (_entropy(class_docs / n_docs)[None] - p_term * _entropy(class_given_term)
+                      - (1 - p_term) * _entropy(class_given_no_term))
+            scores = np.nan_to_num(scores.ravel(), nan=0.0)
+    return token_ids, scores, counts, first_seen
+
+def top_k(scores, k, order):
+    # indices of the k highest scores, ties broken by ascending order, without a full sort
+    if k <= 0:
+        return np.arange(0)
+    if k >= len(scores):
+        selected = np.arange(len(scores))
+    else:
+        partition = np.argpartition(-scores, k - 1)[:k]
+        kth = scores[partition].min()
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)
+        ties = ties[np.argsort(order[ties], kind='stable')][:k - len(above)]
+        selected = np.concatenate([above, ties])
+    return selected[np.lexsort((order[selected], -scores[selected]))]
+
+def select_vocabulary(X, vocabulary_size, y=None, ranking='frequency', clip=10):
+    # returns (vocabulary_ mapping words to columns 1..k, most_common_ as (word, capped
+    # count) pairs in column order, selected scores, and the total_count_ Counter)
+    if not isinstance(X, TokenCounts):
+        X = TokenCounts.from_counters(X)
+    token_ids, scores, counts, first_seen = term_scores(X, y, ranking, clip)
+    selected = top_k(scores, vocabulary_size, first_seen)
+    tokens = X.index.tokens
+    words = [tokens[i] for i in token_ids[selected].tolist()]
+    vocabulary_ = {word: index + 1 for index, word in enumerate(words)}
+    most_common_ = list(zip(words, counts[selected].tolist()))
+    by_appearance = np.argsort(first_seen, kind='stable')
+    total_count_ = Counter(dict(zip([tokens[i] for i in token_ids[by_appearance].tolist()],
+                                    counts[by_appearance].tolist())))
+    return vocabulary_, most_common_, scores[selected], total_count_
 
 
 class WordCounterToVectorTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, vocabulary_size=1000):
+    def __init__(self, vocabulary_size=1000, dtype=np.int64, ranking='frequency'):
         self.vocabulary_size = vocabulary_size
+        self.dtype = dtype
+        self.ranking = ranking
         
     def fit(self, X, y=None):
-        total_count = Counter()
-        for word_count in X:
-            for word, count in word_count.items():
-                total_count[word] += min(count, 10)
-        most_common = total_count.most_common()[:self.vocabulary_size]
-        self.most_common_ = most_common
-        self.vocabulary_ = {word: index + 1 for index, (word, count) in enumerate(most_common)}
+        # ranking='chi2' or 'information_gain' needs y (Pipeline.fit passes it along)
+        self.vocabulary_, self.most_common_, self.scores_, self.total_count_ = select_vocabulary(
+            X, self.vocabulary_size, y, self.ranking)
         return self
     
+    def partial_fit(self, X, y=None):
+        # merges X into the running term counts; columns already assigned never move, and
+        # free columns go to the most frequent new words of this batch (if the vocabulary
+        # is not full yet every word seen before already has a column, so only words of
+        # this batch can be candidates), which keeps the cost proportional to X; new
+        # words are ranked by frequency whatever the ranking
+        if not hasattr(self, 'total_count_'):
+            self.total_count_ = Counter()
+            self.vocabulary_ = {}
+        batch_words = total_word_counts(X)
+        self.total_count_.update(batch_words)
+        free = self.vocabulary_size - len(self.vocabulary_)
+        if free > 0:
+            new_words = [word for word in batch_words if word not in self.vocabulary_]
+            new_words.sort(key=lambda word: self.total_count_[word], reverse=True)
+            for word in new_words[:free]:
+                self.vocabulary_[word] = len(self.vocabulary_) + 1
+        self.most_common_ = [(word, self.total_count_[word]) for word in self.vocabulary_]
+        return self
+    
+    def save_state(self, path):
+        with open(path, 'w') as fp:
+            json.dump({'vocabulary_size': self.vocabulary_size, 'vocabulary_': self.vocabulary_,
+                       'total_count_': self.total_count_}, fp)
+        return path
+    
+    @classmethod
+    def load_state(cls, path, **params):
+        with open(path, 'r') as fp:
+            state = json.load(fp)
+        vectorizer = cls(vocabulary_size=state['vocabulary_size'], **params)
+        vectorizer.total_count_ = Counter(state['total_count_'])
+        vectorizer.vocabulary_ = state['vocabulary_']
+        vectorizer.most_common_ = [(word, vectorizer.total_count_[word]) for word in vectorizer.vocabulary_]
+        return vectorizer
+    
     def transform(self, X, y=None):
-        rows = []
-        cols = []
-        data = []
-        for row, word_count in enumerate(X):
-            for word, count in word_count.items():
-                rows.append(row)
-                cols.append(self.vocabulary_.get(word, 0))
-                data.append(count)
-        return csr_matrix((data, (rows, cols)), shape=(len(X), self.vocabulary_size + 1))
+        return word_counts_to_csr(X, self.vocabulary_, self.vocabulary_size + 1, self.dtype)
     
     
 class WordCounterToVectorTransformer_plusvocab(BaseEstimator, TransformerMixin):
-    def __init__(self, vocabulary_size=1000):
+    def __init__(self, vocabulary_size=1000, dtype=np.int64, ranking='frequency'):
         self.vocabulary_size = vocabulary_size
+        self.dtype = dtype
+        self.ranking = ranking
         
     def fit(self, X, y=None):
-        total_count = Counter()
-        for word_count in X:
-            for word, count in word_count.items():
-                total_count[word] += min(count, 10)
-        most_common = total_count.most_common()[:self.vocabulary_size]
-        self.most_common_ = most_common
-        self.vocabulary_ = {word: index + 1 for index, (word, count) in enumerate(most_common)}
+        self.vocabulary_, self.most_common_, self.scores_, _ = select_vocabulary(
+            X, self.vocabulary_size, y, self.ranking)
         
         return self
     
     def transform(self, X, y=None):
-        rows = []
-        cols = []
-        data = []
-        for row, word_count in enumerate(X):
-            for word, count in word_count.items():
-                rows.append(row)
-                cols.append(self.vocabulary_.get(word, 0))
-                data.append(count)
-      
         # CHANGE - needs vocabulary returned to save and run with test set
         return (self.vocabulary_, 
-                csr_matrix((data, (rows, cols)), shape=(len(X), self.vocabulary_size + 1)))
+                word_counts_to_csr(X, self.vocabulary_, self.vocabulary_size + 1, self.dtype))
+    
+
+class WordCounterToHashedVectorTransformer(BaseEstimator, TransformerMixin):
+    # stateless alternative to WordCounterToVectorTransformer: words are hashed straight
+    # into n_features columns, so there is no vocabulary to fit or store and batches can
+    # be transformed independently (e.g. for SGDClassifier.partial_fit)
+    def __init__(self, n_features=2**20, alternate_sign=False, dtype=np.float64):
+        self.n_features = n_features
+        self.alternate_sign = alternate_sign
+        self.dtype = dtype
+        
+    def fit(self, X, y=None):
+        return self
+    
+    def partial_fit(self, X, y=None):
+        return self
+    
+    def transform(self, X, y=None):
+        profiler = _profiler
+        if profiler is not None:
+            start = time.perf_counter()
+        from sklearn.feature_extraction import FeatureHasher
+        hasher = FeatureHasher(n_features=self.n_features, input_type='dict',
+                               alternate_sign=self.alternate_sign, dtype=self.dtype)
+        if isinstance(X, TokenCounts):
+            # hash each distinct token once, then scatter the counts by id
+            token_ids = np.unique(X.ids)
+            tokens = X.index.tokens
+            columns = np.zeros(len(X.index), dtype=np.int32)
+            signs = np.zeros(len(X.index), dtype=self.dtype)
+            if len(token_ids):
+                hashed = hasher.transform([{tokens[i]: 1} for i in token_ids.tolist()])
+                columns[token_ids] = hashed.indices
+                signs[token_ids] = hashed.data
+            rows = np.repeat(np.arange(len(X)), X.lengths)
+            X_transformed = csr_matrix((signs[X.ids] * X.counts, (rows, columns[X.ids])),
+                                       shape=(len(X), self.n_features), dtype=self.dtype)
+            X_transformed.sum_duplicates()
+        else:
+            X_transformed = hasher.transform(X)
+        if profiler is not None:
+            profiler.record('vectorize_hashed', time.perf_counter() - start, ntokens=X_transformed.nnz)
+        return X_transformed
+    
+
+def partial_fit_pipeline(preprocess_pipeline, classifier, X, y, classes=(0, 1)):
+    # incremental counterpart of fitting the notebooks' preprocess pipeline + model on new
+    # labeled mail: every step that has partial_fit is updated on X only, and the
+    # classifier must support partial_fit too (e.g. SGDClassifier(loss='log_loss'))
+    X_transformed = X
+    for name, step in preprocess_pipeline.steps:
+        if hasattr(step, 'partial_fit'):
+            step.partial_fit(X_transformed, y)
+        X_transformed = step.transform(X_transformed)
+    classifier.partial_fit(X_transformed, y, classes=np.asarray(classes))
+    return classifier
+
+
+# Fitted model bundle: the word counter (its normalizer, warm stem cache and stopword
+# set included), the vectorizer's vocabulary and the classifier in one pickle, fitted
+# once on the training set and then only used to transform and score, so test emails
+# get the training columns. Loading builds no URL extractor, stemmer or NLTK corpus
+# until a transform needs them.
+#
+#   bundle = F.PipelineBundle.fit(X_train, y_train, F.EmailToWordCounterTransformer_revised(False),
+#                                 F.WordCounterToVectorTransformer(), LogisticRegression())
+#   bundle.save('processed_data/model.bundle')
+#   F.PipelineBundle.load('processed_data/model.bundle').predict_proba(X_test)
+
+BUNDLE_VERSION = 1
+
+class PipelineBundle:
+    
+    def __init__(self, word_counter, vectorizer, classifier, metadata=None):
+        self.word_counter = word_counter
+        self.vectorizer = _matrix_vectorizer(vectorizer)
+        self.classifier = classifier
+        self.metadata = metadata or {}
+    
+    @classmethod
+    def fit(cls, X, y, word_counter, vectorizer, classifier, metadata=None):
+        # the emails are normalized once, for both the vocabulary and the classifier
+        word_counts = word_counter.fit_transform(X, y)
+        vectorizer = _matrix_vectorizer(vectorizer.fit(word_counts, y))
+        X_transformed = vectorizer.transform(word_counts)
+        classifier.fit(X_transformed, y)
+        metadata = dict(metadata or {}, n_train=len(y), fitted=dt.datetime.now().isoformat(timespec='seconds'))
+        return cls(word_counter, vectorizer, classifier, metadata)
+    
+    @classmethod
+    def from_pipeline(cls, pipeline, metadata=None):
+        # a fitted Pipeline of word counter, vectorizer and classifier, as in the notebooks
+        (_, word_counter), (_, vectorizer), (_, classifier) = pipeline.steps
+        return cls(word_counter, vectorizer, classifier, metadata)
     
+    @property
+    def vocabulary_(self):
+        return self.vectorizer.vocabulary_
+    
+    def transform(self, X):
+        return self.vectorizer.transform(self.word_counter.transform(X))
+    
+    def predict(self, X):
+        return self.classifier.predict(self.transform(X))
+    
+    def predict_proba(self, X):
+        return self.classifier.predict_proba(self.transform(X))
+    
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # a plain pickle of the bundle, so scoring_service.py and batch_scorer.py load it as a model
+        with open(path + '.tmp', 'wb') as fp:
+            pickle.dump(self, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        return path
+    
+    def __getstate__(self):
+        return dict(self.__dict__, version=BUNDLE_VERSION)
+    
+    def __setstate__(self, state):
+        version = state.pop('version', None)
+        if version != BUNDLE_VERSION:
+            raise ValueError('unsupported bundle version {!r}'.format(version))
+        self.__dict__.update(state)
+    
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fp:
+            bundle = pickle.load(fp)
+        if not isinstance(bundle, cls):
+            raise ValueError('{} is not a {}'.format(path, cls.__name__))
+        return bundle
+
+def _matrix_vectorizer(vectorizer):
+    if isinstance(vectorizer, WordCounterToVectorTransformer_plusvocab):
+        # its (vocabulary_, matrix) output breaks transform(), keep the vocabulary only
+        vectorizer = vectorizer_from_vocabulary(vectorizer.vocabulary_, vectorizer.vocabulary_size,
+                                                vectorizer.dtype)
+    return vectorizer
+
+def vectorizer_from_vocabulary(vocabulary_, vocabulary_size=None, dtype=np.int64):
+    # a transform-only WordCounterToVectorTransformer for a saved vocabulary_ (e.g. the
+    # processed_data json files)
+    vectorizer = WordCounterToVectorTransformer(vocabulary_size=vocabulary_size or len(vocabulary_), dtype=dtype)
+    vectorizer.vocabulary_ = dict(vocabulary_)
+    return vectorizer
+
+
+# Near-duplicate index. Spam arrives in campaigns of near-identical copies, so the
+# verdict scored for one copy is reused for the rest of its campaign. An email's word
+# Counter is summarized by a MinHash signature: the minimum of its tokens under num_perm
+# hash functions, so two signatures agree at a position with probability equal to the
+# Jaccard similarity of their token sets. Signatures are cut into bands, an email is
+# compared only with the clusters sharing a whole band with it, and it joins the most
+# similar one if the estimated similarity reaches threshold. Clusters expire ttl seconds
+# after they were scored and the oldest are evicted beyond maxsize.
+#
+#   scorer = F.NearDuplicateScorer(F.PipelineBundle.load('models/bundle.pkl'))
+#   scorer.predict_proba(X)[:, 1], scorer.index.stats()['hit_rate']
+
+_encode_token = operator.methodcaller('encode', 'utf-8', 'surrogatepass')
+
+class MinHasher:
+    # multiply-shift hashes ((a * x + b) mod 2**64) >> 32 of the crc32 of each token,
+    # with odd multipliers a; crc32 rather than hash() keeps signatures stable across
+    # processes and pickles
+    
+    def __init__(self, num_perm=64, seed=1):
+        self.num_perm = num_perm
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(0, 2**63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.randint(0, 2**63, size=num_perm, dtype=np.uint64)
+    
+    def signature(self, tokens):
+        # tokens: a word Counter (its counts are ignored) or any iterable of strings
+        hashes = np.fromiter(map(zlib.crc32, map(_encode_token, tokens)), dtype=np.uint64)
+        if not len(hashes):
+            return np.full(self.num_perm, 2**32 - 1, dtype=np.uint32)
+        hashed = np.multiply.outer(self.a, hashes) + self.b[:, None]
+        return (hashed.min(axis=1) >> np.uint64(32)).astype(np.uint32)
+
+
+class NearDuplicateIndex:
+    # clusters hold (signature, verdict, expiry) in scoring order, so expired and
+    # evicted clusters both come off the front; band -> cluster and text digest ->
+    # cluster entries of removed clusters are dropped with them or when next looked up
+    
+    def __init__(self, threshold=0.9, num_perm=64, bands=16, maxsize=100000, ttl=3600, seed=1,
+                 clock=time.monotonic):
+        if num_perm % bands:
+            raise ValueError('num_perm ({}) must be a multiple of bands ({})'.format(num_perm, bands))
+        self.threshold = threshold
+        self.bands = bands
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hasher = MinHasher(num_perm, seed)
+        self._rows = num_perm // bands
+        self._clusters = OrderedDict()
+        self._buckets = {}
+        self._digests = OrderedDict()
+        self._next_id = 0
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+    
+    def __len__(self):
+        return len(self._clusters)
+    
+    def signature(self, word_counts):
+        return self.hasher.signature(word_counts)
+    
+    def _band_keys(self, signature):
+        rows = self._rows
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)]
+    
+    def _remove(self, cluster_id):
+        signature, _, _ = self._clusters.pop(cluster_id)
+        for key in self._band_keys(signature):
+            if self._buckets.get(key) == cluster_id:
+                del self._buckets[key]
+    
+    def _expire(self, now):
+        while self._clusters:
+            cluster_id, (_, _, expires) = next(iter(self._clusters.items()))
+            if expires > now:
+                break
+            self._remove(cluster_id)
+            self.expired += 1
+    
+    def lookup(self, digest=None, signature=None):
+        # (cluster id, verdict) of the live cluster holding digest, or else of the most
+        # similar one to signature; the verdict is None while its cluster is still being
+        # scored. A lookup by digest alone that misses is not counted, as the caller goes
+        # on to compute the signature and look up again.
+        self._expire(self.clock())
+        if digest is not None:
+            cluster_id = self._digests.get(digest)
+            if cluster_id in self._clusters:
+                self.exact_hits += 1
+                return cluster_id, self._clusters[cluster_id][1]
+            if cluster_id is not None:
+                del self._digests[digest]
+        if signature is None:
+            return None
+        best, best_similarity = None, self.threshold
+        for key in self._band_keys(signature):
+            cluster_id = self._buckets.get(key)
+            if cluster_id is None or cluster_id == best:
+                continue
+            similarity = np.mean(self._clusters[cluster_id][0] == signature)
+            if similarity >= best_similarity:
+                best, best_similarity = cluster_id, similarity
+        if best is None:
+            self.misses += 1
+            return None
+        self.near_hits += 1
+        if digest is not None:
+            self._add_digest(digest, best)
+        return best, self._clusters[best][1]
+    
+    def _add_digest(self, digest, cluster_id):
+        self._digests[digest] = cluster_id
+        if self.maxsize is not None and len(self._digests) > self.maxsize:
+            self._digests.popitem(last=False)
+    
+    def add(self, signature, verdict=None, digest=None):
+        # starts a cluster and returns its id; its ttl runs from now
+        now = self.clock()
+        self._expire(now)
+        cluster_id = self._next_id
+        self._next_id += 1
+        self._clusters[cluster_id] = (signature, verdict, now + self.ttl)
+        for key in self._band_keys(signature):
+            self._buckets[key] = cluster_id
+        if digest is not None:
+            self._add_digest(digest, cluster_id)
+        if self.maxsize is not None and len(self._clusters) > self.maxsize:
+            self._remove(next(iter(self._clusters)))
+            self.evicted += 1
+        return cluster_id
+    
+    def set_verdict(self, cluster_id, verdict):
+        if cluster_id in self._clusters:
+            signature, _, expires = self._clusters[cluster_id]
+            self._clusters[cluster_id] = (signature, verdict, expires)
+    
+    def discard(self, cluster_id):
+        if cluster_id in self._clusters:
+            self._remove(cluster_id)
+    
+    def clear(self):
+        self._clusters.clear()
+        self._buckets.clear()
+        self._digests.clear()
+    
+    @property
+    def nbytes(self):
+        # signatures only; the dict overhead adds a few hundred bytes per cluster
+        return len(self._clusters) * self.hasher.num_perm * 4
+    
+    def stats(self):
+        hits = self.exact_hits + self.near_hits
+        lookups = hits + self.misses
+        return {'size': len(self._clusters), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                'threshold': self.threshold, 'lookups': lookups, 'exact_hits': self.exact_hits,
+                'near_hits': self.near_hits, 'misses': self.misses, 'expired': self.expired,
+                'evicted': self.evicted, 'hit_rate': hits / lookups if lookups else 0.0}
+
+
+_DIGEST_HEADERS = ('content-type', 'content-transfer-encoding')
+
+def content_digest(email):
+    # hash of everything email_to_text reads: the undecoded part bodies and their raw
+    # Content-Type / Content-Transfer-Encoding values. Parsing those headers through
+    # policy.default costs more than the rest of the text extraction, so copies of one
+    # body under different From/To/Message-ID headers are told apart without it.
+    digest = hashlib.blake2b(digest_size=16)
+    for part in email.walk():
+        for name, value in part.raw_items():
+            if name.lower() in _DIGEST_HEADERS:
+                digest.update(str(value).encode('utf-8', 'surrogateescape') + b'\0')
+        if not part.is_multipart():
+            payload = part.get_payload()
+            digest.update(payload if isinstance(payload, bytes) else
+                          str(payload).encode('utf-8', 'surrogateescape'))
+        digest.update(b'\1')
+    return digest.digest()
+
+
+class NearDuplicateScorer:
+    # scores emails with a PipelineBundle (or any model with its word_counter,
+    # vectorizer and classifier), reusing the probabilities of a recently scored near
+    # duplicate: an identical body skips text extraction and normalization, a similar
+    # word Counter the vectorizer and the classifier. Copies within one batch wait for
+    # the first of them to be scored. Normalization runs in-process, ignoring n_jobs.
+    
+    def __init__(self, bundle, index=None):
+        self.bundle = bundle
+        self.index = NearDuplicateIndex() if index is None else index
+    
+    def predict_proba(self, X):
+        normalizer = self.bundle.word_counter._get_normalizer()
+        index = self.index
+        probabilities = [None] * len(X)
+        waiting = []
+        new_clusters, new_counts = [], []
+        try:
+            for i, email in enumerate(X):
+                digest = content_digest(email)
+                match = index.lookup(digest)
+                if match is None:
+                    word_counts = normalizer.normalize_email(email)
+                    signature = index.signature(word_counts)
+                    match = index.lookup(digest, signature)
+                    if match is None:
+                        new_clusters.append(index.add(signature, digest=digest))
+                        new_counts.append(word_counts)
+                        waiting.append((i, new_clusters[-1]))
+                        continue
+                cluster_id, verdict = match
+                if verdict is None:
+                    waiting.append((i, cluster_id))
+                else:
+                    probabilities[i] = verdict
+            if new_counts:
+                new_probabilities = self.bundle.classifier.predict_proba(
+                    self.bundle.vectorizer.transform(object_array(new_counts)))
+                verdicts = dict(zip(new_clusters, new_probabilities))
+                for cluster_id, verdict in verdicts.items():
+                    index.set_verdict(cluster_id, verdict)
+                for i, cluster_id in waiting:
+                    probabilities[i] = verdicts[cluster_id]
+        except BaseException:
+            # never leave clusters without a verdict behind
+            for cluster_id in new_clusters:
+                index.discard(cluster_id)
+            raise
+        return np.array(probabilities).reshape(len(X), len(self.bundle.classifier.classes_))
+    
+    def predict(self, X):
+        return self.bundle.classifier.classes_[self.predict_proba(X).argmax(axis=1)]
+    
+    def stats(self):
+        return self.index.stats()
+
+# Grid / random search over the notebooks' Pipeline(word counter, vectorizer, classifier)
+# that tokenizes every email once per distinct normalization setting: candidates are
+# grouped by their word counter parameters, each group's TokenCounts is shared by all
+# its folds, vocabulary sizes and classifier settings, and the (candidate, fold) fits
+# run on a process pool. Tokenizing before the split leaks nothing since the word
+# counter is unsupervised; vocabularies are still fitted on the training folds only.
+#
+#   search = F.search_pipeline(pipeline, {'email_to_wordcount__stemming': [True, False],
+#                                         'wordcount_to_vector__vocabulary_size': [500, 1000, 5000]},
+#                              X_train, y_train, cv=3, n_jobs=4)
+#   search['best_params'], search['best_bundle'].predict(X_test)
+
+_worker_search = None
+
+def _init_search_worker(search_state):
+    global _worker_search
+    _worker_search = search_state
+
+def _evaluate_candidate(task):
+    setting, params, fold = task
+    word_counts = _worker_search['word_counts'][setting]
+    train, test = _worker_search['folds'][fold]
+    y = _worker_search['y']
+    estimator = clone(_worker_search['estimator']).set_params(**params)
+    start = time.perf_counter()
+    estimator.fit(word_counts[train], y[train])
+    fit_seconds = time.perf_counter() - start
+    return _worker_search['scorer'](estimator, word_counts[test], y[test]), fit_seconds
+
+def search_pipeline(pipeline, param_grid, X, y, cv=5, scoring='accuracy', n_iter=None, random_state=None,
+                    n_jobs=1, refit=True):
+    # param_grid uses Pipeline names (e.g. 'classifier__C'); with n_iter, that many
+    # candidates are sampled instead of trying the full grid. Returns the candidates
+    # best first, the best params and score, and with refit a PipelineBundle fitted on
+    # all of X with the best params.
+    from sklearn.metrics import get_scorer
+    from sklearn.model_selection import ParameterGrid, ParameterSampler, check_cv
+    from sklearn.pipeline import Pipeline
+    if n_iter is None:
+        candidates = list(ParameterGrid(param_grid))
+    else:
+        candidates = list(ParameterSampler(param_grid, n_iter, random_state=random_state))
+    (counter_name, word_counter), rest = pipeline.steps[0], pipeline.steps[1:]
+    prefix = counter_name + '__'
+    y = np.asarray(y)
+    folds = list(check_cv(cv, y, classifier=True).split(np.zeros((len(y), 1)), y))
+    
+    # one tokenization pass per distinct normalization setting
+    settings, tasks = {}, []
+    for candidate in candidates:
+        counter_params = {key[len(prefix):]: value for key, value in candidate.items() if key.startswith(prefix)}
+        counter = clone(word_counter).set_params(**counter_params)
+        setting = json.dumps(counter.normalization_params(), sort_keys=True, default=str)
+        settings.setdefault(setting, counter_params)
+        params = {key: value for key, value in candidate.items() if not key.startswith(prefix)}
+        tasks += [(setting, params, fold) for fold in range(len(folds))]
+    word_counts = {}
+    for setting, counter_params in settings.items():
+        print('Tokenizing for setting {} of {}...'.format(len(word_counts) + 1, len(settings)))
+        counter = clone(word_counter).set_params(output='token_ids', n_jobs=n_jobs, **counter_params)
+        word_counts[setting] = counter.fit_transform(X)
+    
+    state = {'word_counts': word_counts, 'folds': folds, 'y': y, 'estimator': Pipeline(rest),
+             'scorer': get_scorer(scoring)}
+    n_jobs = effective_n_jobs(n_jobs)
+    print('Fitting {} candidates x {} folds...'.format(len(candidates), len(folds)))
+    if n_jobs == 1:
+        _init_search_worker(state)
+        scores = [_evaluate_candidate(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(n_jobs, initializer=_init_search_worker, initargs=(state,)) as pool:
+            scores = pool.map(_evaluate_candidate, tasks)
+    
+    results = []
+    for index, candidate in enumerate(candidates):
+        fold_scores = np.array([score for score, _ in scores[index * len(folds):(index + 1) * len(folds)]])
+        fit_seconds = sum(seconds for _, seconds in scores[index * len(folds):(index + 1) * len(folds)])
+        results.append({'params': candidate, 'mean_score': float(fold_scores.mean()),
+                        'std_score': float(fold_scores.std()), 'fold_scores': fold_scores.tolist(),
+                        'fit_seconds': fit_seconds})
+    results.sort(key=lambda result: -result['mean_score'])
+    search = {'results': results, 'best_params': results[0]['params'], 'best_score': results[0]['mean_score'],
+              'n_tokenization_passes': len(word_counts)}
+    
+    if refit:
+        best = results[0]['params']
+        setting = tasks[candidates.index(best) * len(folds)][0]
+        counter = clone(word_counter).set_params(**settings[setting]).fit(X)
+        estimator = clone(Pipeline(rest)).set_params(**{key: value for key, value in best.items()
+                                                       if not key.startswith(prefix)})
+        # only the vectorizer and classifier are refitted, on the cached tokens
+        estimator.fit(word_counts[setting], y)
+        (_, vectorizer), (_, classifier) = estimator.steps
+        search['best_bundle'] = PipelineBundle(counter, vectorizer, classifier,
+                                               {'best_params': best, 'cv_score': results[0]['mean_score']})
+    return search
+
 
 def load_processed_X_train(vocab_name, X_train_name, preprocess_pipeline, X_train):
     
@@ -293,6 +2387,108 @@ def load_processed_X_train(vocab_name, X_train_name, preprocess_pipeline, X_trai
     print('Processed data loaded and saved.')   
     return(vocabulary_, X_train_transformed)  
     
+# Processed-data artifact: one file holding a CSR matrix and its vocabulary as raw
+# arrays that can be memory-mapped, so worker processes share one copy through the
+# page cache and loading decompresses nothing.
+#
+#   magic (8 bytes) | format version (uint32) | header length (uint32) | json header
+#   | 64-byte aligned sections: indptr, indices, data, vocabulary offsets, vocabulary words
+#
+# The header records shape, dtypes and section offsets, the pipeline parameters the
+# matrix was produced with, and a sha256 of everything after the header.
+
+ARTIFACT_MAGIC = b'SPAMCSR\0'
+ARTIFACT_VERSION = 1
+_ARTIFACT_ALIGN = 64
+
+def _aligned(offset):
+    return -(-offset // _ARTIFACT_ALIGN) * _ARTIFACT_ALIGN
+
+def save_artifact(path, X, vocabulary_=None, params=None):
+    X = csr_matrix(X)
+    X.sort_indices()
+    index_dtype = np.int32 if X.nnz < 2**31 and X.shape[1] < 2**31 else np.int64
+    vocabulary_ = vocabulary_ or {}
+    words = sorted(vocabulary_, key=vocabulary_.get)
+    encoded = [word.encode('utf-8') for word in words]
+    columns = np.array([vocabulary_[word] for word in words], dtype=np.int64)
+    word_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded], out=word_offsets[1:])
+    arrays = [('indptr', X.indptr.astype(index_dtype, copy=False)),
+              ('indices', X.indices.astype(index_dtype, copy=False)),
+              ('data', X.data),
+              ('vocabulary_columns', columns),
+              ('vocabulary_offsets', word_offsets),
+              ('vocabulary_words', np.frombuffer(b''.join(encoded), dtype=np.uint8))]
+    
+    sections = {}
+    offset = 0
+    for name, array in arrays:
+        sections[name] = {'offset': offset, 'dtype': array.dtype.str, 'length': len(array)}
+        offset = _aligned(offset + array.nbytes)
+    checksum = hashlib.sha256()
+    for name, array in arrays:
+        checksum.update(np.ascontiguousarray(array).tobytes())
+    header = json.dumps({'shape': list(X.shape), 'sections': sections, 'params': params or {},
+                         'sha256': checksum.hexdigest()}, default=str).encode('utf-8')
+    
+    payload_start = _aligned(len(ARTIFACT_MAGIC) + 8 + len(header))
+    with open(path, 'wb') as fp:
+        fp.write(ARTIFACT_MAGIC)
+        fp.write(np.array([ARTIFACT_VERSION, len(header)], dtype='<u4').tobytes())
+        fp.write(header)
+        for name, array in arrays:
+            fp.seek(payload_start + sections[name]['offset'])
+            fp.write(np.ascontiguousarray(array).tobytes())
+        fp.truncate(payload_start + offset)
+    return path
+
+def read_artifact_header(path):
+    with open(path, 'rb') as fp:
+        magic = fp.read(len(ARTIFACT_MAGIC))
+        if magic != ARTIFACT_MAGIC:
+            raise ValueError('{} is not a processed-data artifact.'.format(path))
+        version, header_length = np.frombuffer(fp.read(8), dtype='<u4')
+        if version != ARTIFACT_VERSION:
+            raise ValueError('Unsupported artifact version {} (expected {}).'.format(version, ARTIFACT_VERSION))
+        header = json.loads(fp.read(int(header_length)).decode('utf-8'))
+    header['payload_start'] = _aligned(len(ARTIFACT_MAGIC) + 8 + int(header_length))
+    return header
+
+def load_artifact(path, mmap=True, verify=False, params=None):
+    # returns (vocabulary_, X) like load_processed_X_train; with mmap=True the matrix
+    # arrays are read-only views of the file, with verify=True the checksum is checked
+    # (which reads the whole file), and params, when given, must match the header
+    header = read_artifact_header(path)
+    if params is not None and json.loads(json.dumps(params, default=str)) != header['params']:
+        raise ValueError('Artifact {} was produced with different parameters: {}'.format(path, header['params']))
+    
+    def section(name):
+        info = header['sections'][name]
+        if info['length'] == 0:
+            return np.empty(0, dtype=info['dtype'])
+        offset = header['payload_start'] + info['offset']
+        if mmap:
+            return np.memmap(path, dtype=info['dtype'], mode='r', offset=offset, shape=(info['length'],))
+        return np.fromfile(path, dtype=info['dtype'], count=info['length'], offset=offset)
+    
+    names = ('indptr', 'indices', 'data', 'vocabulary_columns', 'vocabulary_offsets', 'vocabulary_words')
+    arrays = {name: section(name) for name in names}
+    if verify:
+        checksum = hashlib.sha256()
+        for name in names:
+            checksum.update(np.asarray(arrays[name]).tobytes())
+        if checksum.hexdigest() != header['sha256']:
+            raise ValueError('Checksum mismatch for artifact {}.'.format(path))
+    
+    X = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(header['shape']), copy=False)
+    blob = bytes(arrays['vocabulary_words'])
+    offsets = arrays['vocabulary_offsets'].tolist()
+    vocabulary_ = {blob[offsets[i]:offsets[i + 1]].decode('utf-8'): column
+                   for i, column in enumerate(arrays['vocabulary_columns'].tolist())}
+    return(vocabulary_, X)
+
+
 # -------------------------------------------------------------------------------------------------------------
 # Studying scikit-learn TransformerMixin and BaseEstimator classes
 
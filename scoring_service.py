@@ -0,0 +1,217 @@
+import sys
+import json
+import time
+import queue
+import pickle
+import argparse
+import threading
+import email
+import email.policy
+import numpy as np
+import urllib.request
+
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import custom_functions as F
+
+# Long-lived scoring process. Loads a pickled, fitted pipeline once (e.g. the notebooks'
+# preprocess Pipeline with a classifier as last step) and scores raw RFC822 messages:
+#
+#   python scoring_service.py model.pkl --port 8025
+#
+#   POST /score   body = raw message bytes  ->  {"spam_probability": 0.97}
+#   GET  /stats                             ->  request count and p50/p99 latency (ms)
+#   GET  /metrics                           ->  per-stage Prometheus metrics (with --profile)
+#
+# With --near-duplicates (for a model saved with PipelineBundle.save) copies of recently
+# scored campaigns reuse their verdict, and /stats reports the index hit rate.
+#
+# Concurrent requests are grouped into micro-batches so the pipeline runs vectorized.
+
+
+def load_model(path):
+    with open(path, 'rb') as fp:
+        return pickle.load(fp)
+
+
+class LatencyRecorder:
+    # keeps the last `window` latencies for percentiles, plus running totals
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.count += 1
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            count = self.count
+        if not len(latencies):
+            return {'requests': count, 'p50_ms': None, 'p99_ms': None}
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        return {'requests': count, 'p50_ms': round(p50, 3), 'p99_ms': round(p99, 3)}
+
+
+class MicroBatcher:
+    # request threads submit raw messages and wait on a Future; one worker thread drains
+    # the queue into batches of at most max_batch_size, waiting up to max_delay seconds
+    # for a batch to fill, and scores each batch with a single predict_proba call
+    def __init__(self, model, max_batch_size=64, max_delay=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.parser = email.parser.BytesParser(policy=email.policy.default)
+        self.queue = queue.Queue()
+        self.latency = LatencyRecorder()
+        self.batch_sizes = deque(maxlen=1000)
+        self.batch_sizes_lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, raw):
+        future = Future()
+        self.queue.put((raw, future, time.perf_counter()))
+        return future
+
+    def score(self, raw, timeout=None):
+        return self.submit(raw).result(timeout)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                profiler = F.get_profiler()
+                if profiler is not None:
+                    parse_start = time.perf_counter()
+                X = F.object_array([self.parser.parsebytes(raw) for raw, _, _ in batch])
+                if profiler is not None:
+                    profiler.record('parse', time.perf_counter() - parse_start,
+                                    nbytes=sum(len(raw) for raw, _, _ in batch))
+                probabilities = self.model.predict_proba(X)[:, 1]
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            with self.batch_sizes_lock:
+                self.batch_sizes.append(len(batch))
+            for (_, future, start), probability in zip(batch, probabilities):
+                self.latency.record(now - start)
+                future.set_result(float(probability))
+
+    def stats(self):
+        stats = self.latency.stats()
+        # the worker thread appends while /stats requests read
+        with self.batch_sizes_lock:
+            batch_sizes = list(self.batch_sizes)
+        stats['mean_batch_size'] = round(float(np.mean(batch_sizes)), 2) if batch_sizes else None
+        if isinstance(self.model, F.NearDuplicateScorer):
+            stats['near_duplicates'] = self.model.stats()
+        return stats
+
+
+def make_handler(batcher):
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != '/score':
+                return self._reply(404, {'error': 'not found'})
+            raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                self._reply(200, {'spam_probability': batcher.score(raw)})
+            except Exception as e:
+                self._reply(500, {'error': repr(e)})
+
+        def do_GET(self):
+            if self.path == '/metrics' and F.get_profiler() is not None:
+                body = F.get_profiler().to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                return self.wfile.write(body)
+            if self.path != '/stats':
+                return self._reply(404, {'error': 'not found'})
+            self._reply(200, batcher.stats())
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+
+def serve(model, host='127.0.0.1', port=8025, max_batch_size=64, max_delay=0.005):
+    batcher = MicroBatcher(model, max_batch_size=max_batch_size, max_delay=max_delay)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    server.daemon_threads = True
+    return server
+
+
+def score(raw, url='http://127.0.0.1:8025'):
+    # minimal client, standing in for the MTA
+    request = urllib.request.Request(url + '/score', data=raw, method='POST',
+                                     headers={'Content-Type': 'message/rfc822'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())['spam_probability']
+
+
+def stats(url='http://127.0.0.1:8025'):
+    with urllib.request.urlopen(url + '/stats') as response:
+        return json.loads(response.read())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score raw RFC822 messages with a pickled, fitted pipeline.')
+    parser.add_argument('model', help='pickled pipeline ending with a classifier that has predict_proba')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-delay-ms', type=float, default=5.0)
+    parser.add_argument('--profile', action='store_true', help='record per-stage metrics, served on /metrics')
+    parser.add_argument('--near-duplicates', action='store_true', help='reuse verdicts of recently scored near duplicates')
+    parser.add_argument('--near-duplicate-ttl', type=float, default=3600, help='seconds a verdict is reused for')
+    parser.add_argument('--near-duplicate-maxsize', type=int, default=100000, help='clusters kept in the index')
+    args = parser.parse_args()
+    if args.profile:
+        F.enable_profiling()
+    model = load_model(args.model)
+    if args.near_duplicates:
+        if not isinstance(model, F.PipelineBundle):
+            parser.error('--near-duplicates needs a model saved with PipelineBundle.save')
+        model = F.NearDuplicateScorer(model, F.NearDuplicateIndex(maxsize=args.near_duplicate_maxsize,
+                                                                  ttl=args.near_duplicate_ttl))
+    server = serve(model, args.host, args.port, args.max_batch_size, args.max_delay_ms / 1000)
+    print('Scoring on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        sys.exit(0)